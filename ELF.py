@@ -5,9 +5,26 @@ import uuid
 import asyncio
 import shutil
 import json
+import string
+import time
+import functools
+import queue
+import threading
+import bisect
+import glob
+import hashlib
+import math
+import re
+import gzip
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from urllib.parse import urlparse
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot, Dispatcher, types, executor
 from aiohttp import web
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
@@ -15,6 +32,7 @@ from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils.callback_data import CallbackData
+from aiogram.utils.exceptions import RetryAfter, NetworkError, TelegramAPIError, Unauthorized, ChatNotFound
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -96,12 +114,265 @@ user_messages = {}
 # In-memory storage for banned users (cache for quick checks and handler filter)
 banned_users = set()
 
+# Спец-пользователи из таблицы special_users. Вместе с SPECIAL_SET_DEALS_IDS (код + JSON)
+# образуют реестр ролей: проверка роли — две проверки по set, без запросов к БД.
+special_user_ids = set()
+special_roles_stats = {'reloads': 0, 'last_reload_ms': 0.0, 'loaded_at': None}
+
+class TTLCache:
+    """Ограниченный LRU-кэш с TTL и счетчиками попаданий/промахов. Потокобезопасен."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def add(self, key, value):
+        """Кладет значение, только если ключа еще нет (не затирает свежую запись писателя)."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._evict()
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+# Кэш языка пользователя: get_text вызывается на каждую кнопку и не должен ходить в БД
+LANG_CACHE_SIZE = int(os.getenv('LANG_CACHE_SIZE', '50000'))
+LANG_CACHE_TTL = float(os.getenv('LANG_CACHE_TTL', '3600'))
+language_cache = TTLCache(LANG_CACHE_SIZE, LANG_CACHE_TTL)
+
+# Кэш сделок для ссылок pay_<memo>: строка deals лежит под ключами ('memo', memo)
+# и ('id', deal_id). Хелперы, меняющие сделку, кладут в кэш свежую строку
+# из RETURNING, так что читатель с устаревшей строкой ее не затрет (add).
+# Рядом — карточка продавца (username, successful_deals) по user_id.
+DEAL_CACHE_SIZE = int(os.getenv('DEAL_CACHE_SIZE', '2048'))
+DEAL_CACHE_TTL = float(os.getenv('DEAL_CACHE_TTL', '60'))
+deal_cache = TTLCache(DEAL_CACHE_SIZE, DEAL_CACHE_TTL)
+creator_cache = TTLCache(DEAL_CACHE_SIZE, DEAL_CACHE_TTL)
+
+class BloomFilter:
+    """Фильтр Блума: "точно нет" или "возможно есть". Потокобезопасен для add/проверки."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        positions = self._positions(key)
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+# Отсев мусорных и несуществующих memo до похода в БД. Формат memo —
+# uuid4().hex[:8]; известные memo — в фильтре Блума (~1.2 МБ на 1М сделок
+# при 1% ложных срабатываний; ложное срабатывание просто доходит до БД).
+MEMO_RE = re.compile(r'[0-9a-f]{8}')
+KNOWN_MEMOS_MIN_CAPACITY = int(os.getenv('KNOWN_MEMOS_MIN_CAPACITY', '100000'))
+known_memos = BloomFilter(KNOWN_MEMOS_MIN_CAPACITY)
+memo_filter_stats = {'bad_format': 0, 'unknown': 0, 'passed': 0, 'false_positives': 0}
+
 # Подключение к базе данных
-def init_db():
-    conn = sqlite3.connect('elf_otc.db')
-    cursor = conn.cursor()
+DB_PATH = os.getenv('DB_PATH', 'elf_otc.db')
+# Количество соединений-читателей в пуле (писатель всегда один)
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+
+class ConnectionPool:
+    """Долгоживущие соединения с SQLite: один писатель и небольшой пул читателей.
+
+    Соединения открываются лениво, один раз, в режиме WAL — читатели не ждут
+    писателя, а прагмы не приходится выставлять на каждый запрос.
+    """
+
+    PRAGMAS = (
+        'PRAGMA busy_timeout = 5000',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA cache_size = -16000',
+        'PRAGMA mmap_size = 134217728',
+    )
 
-    # Создаем таблицы, если их нет
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._open_lock = threading.Lock()
+
+    def _connect(self, readonly: bool = False):
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def _get_writer(self):
+        if self._writer is None:
+            self._writer = self._connect()
+            mode = self._writer.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+            logger.info(f"SQLite writer opened: {self.path} (journal_mode={mode})")
+        return self._writer
+
+    @contextmanager
+    def write(self):
+        """Единственное соединение-писатель. Вложенные блоки коммитятся одним разом на внешнем уровне."""
+        with self._write_lock:
+            conn = self._get_writer()
+            self._write_depth += 1
+            try:
+                yield conn
+            except BaseException:
+                if self._write_depth == 1:
+                    conn.rollback()
+                raise
+            else:
+                if self._write_depth == 1:
+                    conn.commit()
+            finally:
+                self._write_depth -= 1
+
+    @contextmanager
+    def read(self):
+        """Соединение-читатель из пула; при исчерпании пула ждем освобождения."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            # Писатель должен переключить файл в WAL до первого читателя
+            if self._writer is None:
+                with self._write_lock:
+                    self._get_writer()
+            with self._open_lock:
+                can_open = self._opened < self.readers
+                if can_open:
+                    self._opened += 1
+            conn = self._connect(readonly=True) if can_open else self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                try:
+                    self._writer.execute('PRAGMA optimize')
+                    self._writer.close()
+                except sqlite3.Error:
+                    pass
+                self._writer = None
+        with self._open_lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._opened = 0
+
+db = ConnectionPool(DB_PATH, DB_READERS)
+
+# Отдельные потоки для SQLite: блокирующие запросы и fsync не держат event loop.
+# Записи все равно идут строго по одной — через единственного писателя пула.
+_db_executor = ThreadPoolExecutor(max_workers=DB_READERS + 1, thread_name_prefix='db')
+# Счетчики DB-задач: pending — поставлены в очередь или выполняются прямо сейчас
+db_job_stats = {'pending': 0, 'peak': 0, 'total': 0}
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронный DB-хелпер в потоке БД и возвращает его результат."""
+    loop = asyncio.get_running_loop()
+    db_job_stats['pending'] += 1
+    db_job_stats['total'] += 1
+    db_job_stats['peak'] = max(db_job_stats['peak'], db_job_stats['pending'])
+    try:
+        return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        db_job_stats['pending'] -= 1
+
+def shutdown_db():
+    # Идущий бэкап прерываем: недописанный файл удаляется
+    backup_state['cancel'] = True
+    _backup_executor.shutdown(wait=True)
+    _db_executor.shutdown(wait=True)
+    db.close()
+
+# Версионированные миграции схемы.
+# Текущая версия хранится в PRAGMA user_version; каждая миграция применяется
+# ровно один раз в своей транзакции. Длинные заполнения данных (backfill)
+# не держат старт: миграция лишь регистрирует их, а выполняются они
+# пачками в фоне, пока бот уже обслуживает пользователей.
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', '5000'))
+BACKFILL_PAUSE = float(os.getenv('BACKFILL_PAUSE', '0.05'))
+# Сколько дней хранить свертку активности (должно покрывать самое длинное окно статистики)
+ACTIVITY_ROLLUP_DAYS = 8
+
+def _migration_base_schema(cursor):
+    # Создаем таблицы, если их нет (для старых баз они уже существуют)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -114,7 +385,9 @@ def init_db():
             referral_count INTEGER DEFAULT 0,
             earned_from_referrals REAL DEFAULT 0.0,
             successful_deals INTEGER DEFAULT 0,
-            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            banned BOOLEAN DEFAULT FALSE,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
 
@@ -173,92 +446,493 @@ def init_db():
         )
     ''')
 
-    # Миграции: добавляем при необходимости недостающие колонки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER,
+            done BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Базы, созданные до появления колонок banned/last_active.
+    # SQLite не умеет добавлять колонку с DEFAULT CURRENT_TIMESTAMP в непустую
+    # таблицу, поэтому last_active добавляем без значения по умолчанию и
+    # заполняем фоновым backfill'ом.
     cursor.execute("PRAGMA table_info(users)")
     cols = {row[1] for row in cursor.fetchall()}
     if 'banned' not in cols:
         cursor.execute("ALTER TABLE users ADD COLUMN banned BOOLEAN DEFAULT FALSE")
     if 'last_active' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+        cursor.execute("ALTER TABLE users ADD COLUMN last_active TIMESTAMP")
+        schedule_backfill(cursor, 'users_last_active')
+
+def _migration_hot_indexes(cursor):
+    # Индексы под горячие запросы (статистика, списки в админке, топ)
+    for ddl in INDEXES:
+        cursor.execute(ddl)
+
+def _migration_stats_counters(cursor):
+    # Счетчики для get_stats поддерживаются триггерами: экран статистики
+    # больше не считает COUNT(*) по таблицам пользователей и сделок.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users_total', COUNT(*) FROM users")
+    cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'deals_total', COUNT(*) FROM deals")
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'deals_status:' || ifnull(status, 'active'), COUNT(*) FROM deals GROUP BY ifnull(status, 'active')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users_total';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users_total';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_deals_count_insert AFTER INSERT ON deals BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'deals_total';
+            INSERT INTO stats_counters (name, value) VALUES ('deals_status:' || ifnull(NEW.status, 'active'), 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_deals_count_delete AFTER DELETE ON deals BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'deals_total';
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'deals_status:' || ifnull(OLD.status, 'active');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_deals_count_status AFTER UPDATE OF status ON deals
+        WHEN ifnull(OLD.status, 'active') IS NOT ifnull(NEW.status, 'active') BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'deals_status:' || ifnull(OLD.status, 'active');
+            INSERT INTO stats_counters (name, value) VALUES ('deals_status:' || ifnull(NEW.status, 'active'), 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+    ''')
+
+    # Свертка активности по дням: одна строка на пользователя в день с последним
+    # временем активности. Окна 24ч/7д считаются по нескольким дням свертки
+    # вместо прохода по users.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_seen TIMESTAMP NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO user_activity_daily (day, user_id, last_seen)
+        SELECT date(last_active), user_id, last_active FROM users
+        WHERE last_active >= datetime('now', '-{ACTIVITY_ROLLUP_DAYS} day')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_activity_insert AFTER INSERT ON users
+        WHEN NEW.last_active IS NOT NULL BEGIN
+            INSERT INTO user_activity_daily (day, user_id, last_seen) VALUES (date(NEW.last_active), NEW.user_id, NEW.last_active)
+                ON CONFLICT(day, user_id) DO UPDATE SET last_seen = max(last_seen, excluded.last_seen);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_activity_update AFTER UPDATE OF last_active ON users
+        WHEN NEW.last_active IS NOT NULL BEGIN
+            INSERT INTO user_activity_daily (day, user_id, last_seen) VALUES (date(NEW.last_active), NEW.user_id, NEW.last_active)
+                ON CONFLICT(day, user_id) DO UPDATE SET last_seen = max(last_seen, excluded.last_seen);
+        END
+    ''')
+
+def _migration_deals_keyset_index(cursor):
+    # Keyset-пагинация сделок идет по (created_at, deal_id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_created_id ON deals (created_at, deal_id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_deals_created_at')
 
-    conn.commit()
-    conn.close()
+def _migration_users_fts(cursor):
+    # Полнотекстовый индекс для поиска пользователей в админке. Триграммный
+    # токенайзер находит подстроку в любом месте имени (как LIKE '%q%'),
+    # но по индексу. rowid = user_id; синхронизация — триггерами на users,
+    # существующие строки индексируются фоновым backfill'ом.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, first_name, last_name, tokenize = 'trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name);
+        END
+    ''')
+    # touch_user обновляет имена при каждом изменении профиля — индекс трогаем, только если они изменились
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, first_name, last_name ON users
+        WHEN OLD.username IS NOT NEW.username OR OLD.first_name IS NOT NEW.first_name
+             OR OLD.last_name IS NOT NEW.last_name BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.user_id;
+            INSERT INTO users_fts (rowid, username, first_name, last_name)
+            VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.user_id;
+        END
+    ''')
+    # Точное совпадение username поднимается в выдаче первым, даже если
+    # пользователь старый и не попал в окно кандидатов FTS
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)')
+    schedule_backfill(cursor, 'users_fts')
+
+def _migration_logs_retention(cursor):
+    # Хранение логов: старые записи переносятся пачками в logs_archive,
+    # а суточные счетчики по action остаются в logs_daily навсегда.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logs_archive (
+            log_id INTEGER PRIMARY KEY,
+            actor_id INTEGER,
+            action TEXT,
+            details TEXT,
+            created_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logs_daily (
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, action)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO logs_daily (day, action, count)
+        SELECT date(created_at), ifnull(action, ''), COUNT(*) FROM logs GROUP BY 1, 2
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_logs_daily_insert AFTER INSERT ON logs BEGIN
+            INSERT INTO logs_daily (day, action, count) VALUES (date(NEW.created_at), ifnull(NEW.action, ''), 1)
+                ON CONFLICT(day, action) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    # Фильтры просмотра логов в админке
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_logs_actor_created ON logs (actor_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_logs_action_created ON logs (action, created_at)')
+
+def _migration_broadcast_jobs(cursor):
+    # Рассылки переживают рестарт: cursor — последний id получателя, до которого
+    # включительно все обработаны; errors — JSON {тип ошибки: количество}
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            errors TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+def _migration_broadcast_audience(cursor):
+    # Фильтры аудитории рассылок: недоступные получатели (заблокировали бота,
+    # удалили аккаунт, выгнали из чата) помечаются движком рассылки и
+    # пропускаются; has deals ищет сделки по индексам creator_id/buyer_id
+    cursor.execute('ALTER TABLE users ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE chats ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE broadcast_jobs ADD COLUMN filters TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_creator_id ON deals (creator_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_buyer_id ON deals (buyer_id)')
+
+def _migration_leaderboard_index(cursor):
+    # TOP_SUCCESSFUL_SQL сортирует с тай-брейком по user_id; в старом индексе
+    # username стоял перед rowid, и SQLite досортировывал хвост во временном b-tree
+    cursor.execute('DROP INDEX IF EXISTS idx_users_successful')
+    cursor.execute('CREATE INDEX idx_users_successful ON users (successful_deals DESC, registered_at, user_id, username)')
+
+# Упорядоченный список миграций: (версия, описание, функция)
+MIGRATIONS = [
+    (1, 'base schema', _migration_base_schema),
+    (2, 'hot query indexes', _migration_hot_indexes),
+    (3, 'stats counters and daily activity rollup', _migration_stats_counters),
+    (4, 'deals keyset pagination index', _migration_deals_keyset_index),
+    (5, 'users full-text search index', _migration_users_fts),
+    (6, 'logs archive, daily rollup and filter indexes', _migration_logs_retention),
+    (7, 'persistent broadcast jobs', _migration_broadcast_jobs),
+    (8, 'broadcast audience filters', _migration_broadcast_audience),
+    (9, 'leaderboard index covers user_id tie-break', _migration_leaderboard_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schedule_backfill(cursor, name: str):
+    """Регистрирует backfill из BACKFILLS; выполняется в фоне после старта."""
+    cursor.execute('INSERT OR REPLACE INTO schema_backfills (name, cursor, done) VALUES (?, NULL, 0)', (name,))
+
+def _backfill_users_last_active(conn, after, batch_size):
+    rows = conn.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                        (after, batch_size)).fetchall()
+    if not rows:
+        return None
+    conn.execute('UPDATE users SET last_active = registered_at WHERE user_id BETWEEN ? AND ? AND last_active IS NULL',
+                 (rows[0][0], rows[-1][0]))
+    return rows[-1][0]
+
+def _backfill_users_fts(conn, after, batch_size):
+    rows = conn.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                        (after, batch_size)).fetchall()
+    if not rows:
+        return None
+    # Строки, уже попавшие в индекс через триггеры, пропускаем
+    conn.execute('''
+        INSERT INTO users_fts (rowid, username, first_name, last_name)
+        SELECT u.user_id, u.username, u.first_name, u.last_name FROM users u
+        WHERE u.user_id BETWEEN ? AND ? AND NOT EXISTS (SELECT 1 FROM users_fts f WHERE f.rowid = u.user_id)
+    ''', (rows[0][0], rows[-1][0]))
+    return rows[-1][0]
+
+# Backfill'ы: имя -> функция(conn, курсор, размер пачки) -> новый курсор или None, если все готово
+BACKFILLS = {
+    'users_last_active': _backfill_users_last_active,
+    'users_fts': _backfill_users_fts,
+}
+
+def init_db():
+    with db.write() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        cursor = conn.cursor()
+        for target, title, migrate in MIGRATIONS:
+            if target <= version:
+                continue
+            started = time.perf_counter()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                migrate(cursor)
+                cursor.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Schema migrated to v{target} ({title}) in {time.perf_counter() - started:.2f}s")
+
+def pending_backfills():
+    with db.read() as conn:
+        try:
+            return [r[0] for r in conn.execute('SELECT name FROM schema_backfills WHERE done = 0 ORDER BY name')]
+        except sqlite3.OperationalError:
+            return []
+
+def run_backfill_batch(name: str) -> bool:
+    """Одна пачка backfill'а в одной транзакции вместе с курсором. True — backfill завершен."""
+    with db.write() as conn:
+        row = conn.execute('SELECT cursor FROM schema_backfills WHERE name = ?', (name,)).fetchone()
+        after = row[0] if row and row[0] is not None else -(2 ** 63)
+        next_cursor = BACKFILLS[name](conn, after, BACKFILL_BATCH_SIZE)
+        conn.execute('UPDATE schema_backfills SET cursor = ?, done = ?, updated_at = CURRENT_TIMESTAMP WHERE name = ?',
+                     (next_cursor if next_cursor is not None else after, next_cursor is None, name))
+    return next_cursor is None
+
+async def run_pending_backfills():
+    for name in await run_db(pending_backfills):
+        if name not in BACKFILLS:
+            logger.warning(f"Unknown backfill {name!r} skipped")
+            continue
+        started = time.perf_counter()
+        logger.info(f"Backfill {name} started")
+        while not await run_db(run_backfill_batch, name):
+            await asyncio.sleep(BACKFILL_PAUSE)
+        logger.info(f"Backfill {name} finished in {time.perf_counter() - started:.1f}s")
+
+INDEXES = (
+    # get_stats: активность за день/неделю
+    'CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)',
+    # get_users / find_user: сортировка по дате регистрации
+    'CREATE INDEX IF NOT EXISTS idx_users_registered_at ON users (registered_at)',
+    # get_top_successful_users: покрывающий индекс (в v9 пересоздан с user_id для тай-брейка)
+    'CREATE INDEX IF NOT EXISTS idx_users_successful ON users (successful_deals DESC, registered_at, username)',
+    # list_deals: последние сделки
+    'CREATE INDEX IF NOT EXISTS idx_deals_created_at ON deals (created_at)',
+    # get_stats по статусу и список успешных (status + completed_at)
+    'CREATE INDEX IF NOT EXISTS idx_deals_status_completed ON deals (status, completed_at)',
+    # Просмотр логов в админке
+    'CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs (created_at)',
+)
 
 def load_banned_users():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
+    with db.read() as conn:
+        cur = conn.cursor()
         cur.execute('SELECT user_id FROM users WHERE banned = 1')
         rows = cur.fetchall()
-    finally:
-        conn.close()
     banned_users.clear()
     banned_users.update([r[0] for r in rows])
 
-def get_top_successful_users(limit: int = 10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT user_id, username, successful_deals
-        FROM users
-        WHERE successful_deals > 0
-        ORDER BY successful_deals DESC, registered_at ASC
-        LIMIT ?
-        """,
-        (limit,)
-    )
-    rows = cursor.fetchall()
-    conn.close()
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '50'))
+LEADERBOARD_RECONCILE_INTERVAL = int(os.getenv('LEADERBOARD_RECONCILE_INTERVAL', '600'))
+
+TOP_SUCCESSFUL_SQL = """
+    SELECT user_id, username, successful_deals, registered_at
+    FROM users
+    WHERE successful_deals > 0
+    ORDER BY successful_deals DESC, registered_at ASC, user_id ASC
+    LIMIT ?
+"""
+
+class Leaderboard:
+    """Топ пользователей по успешным сделкам в памяти. Потокобезопасен.
+
+    Держит до capacity лучших записей в отсортированном списке ключей
+    (-сделки, registered_at, user_id). boundary — ключ, хуже или равный которому
+    все пользователи вне топа (None — в топе все, у кого есть сделки). Пока
+    в топе хватает записей или он полный, чтение не ходит в БД.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._keys = []
+        self._entries = {}
+        self._boundary = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_id, count, registered_at):
+        return (-count, registered_at or '', user_id)
+
+    def seed(self, rows):
+        """rows — результат TOP_SUCCESSFUL_SQL с LIMIT capacity."""
+        with self._lock:
+            self._entries = {uid: (self._key(uid, cnt, reg), uname) for uid, uname, cnt, reg in rows}
+            self._keys = sorted(key for key, _ in self._entries.values())
+            self._boundary = self._keys[-1] if len(self._keys) >= self.capacity else None
+            self._loaded = True
+
+    def update(self, user_id, count, registered_at, username):
+        """Новое значение successful_deals пользователя (вызывается под блокировкой записи в БД)."""
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old is not None:
+                del self._keys[bisect.bisect_left(self._keys, old[0])]
+            key = self._key(user_id, count, registered_at)
+            if count <= 0 or (self._boundary is not None and key >= self._boundary):
+                # Вне топа; если он был в топе, место освободилось — дозагрузим при чтении
+                return
+            bisect.insort(self._keys, key)
+            self._entries[user_id] = (key, username)
+            if len(self._keys) > self.capacity:
+                dropped = self._keys.pop()
+                del self._entries[dropped[2]]
+                self._boundary = dropped
+
+    def rename(self, user_id, username):
+        """Новый username пользователя, если он в топе (вызывается под блокировкой записи в БД)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] != username:
+                self._entries[user_id] = (entry[0], username)
+
+    def top(self, limit: int):
+        """Первые limit записей [(user_id, username, count)] или None, если нужна перезагрузка из БД."""
+        with self._lock:
+            if not self._loaded or (len(self._keys) < limit and self._boundary is not None):
+                return None
+            return [(key[2], self._entries[key[2]][1], -key[0]) for key in self._keys[:limit]]
+
+    def snapshot(self):
+        with self._lock:
+            return [(key[2], self._entries[key[2]][1], -key[0], key[1]) for key in self._keys]
+
+leaderboard = Leaderboard(LEADERBOARD_SIZE)
+leaderboard_stats = {'hits': 0, 'reloads': 0, 'reconciles': 0, 'drift_fixes': 0, 'last_drift_at': None}
+
+def load_leaderboard(conn=None):
+    if conn is None:
+        # Под блокировкой записи: инкременты не проскочат между чтением и заменой топа
+        with db.write() as conn:
+            return load_leaderboard(conn)
+    rows = conn.execute(TOP_SUCCESSFUL_SQL, (leaderboard.capacity,)).fetchall()
+    leaderboard.seed(rows)
     return rows
 
+def get_top_successful_users(limit: int = 10):
+    top = leaderboard.top(limit)
+    if top is None:
+        leaderboard_stats['reloads'] += 1
+        load_leaderboard()
+        top = leaderboard.top(limit)
+    else:
+        leaderboard_stats['hits'] += 1
+    return top
+
+def reconcile_leaderboard() -> bool:
+    """Сверка топа в памяти с БД. True — было расхождение, топ перезагружен."""
+    with db.write() as conn:
+        current = leaderboard.snapshot()
+        rows = [tuple(r) for r in conn.execute(TOP_SUCCESSFUL_SQL, (leaderboard.capacity,)).fetchall()]
+        leaderboard.seed(rows)
+    leaderboard_stats['reconciles'] += 1
+    # Топ мог законно укоротиться (кто-то выбыл) — сравниваем общую часть
+    drift = current != rows[:len(current)]
+    if drift:
+        leaderboard_stats['drift_fixes'] += 1
+        leaderboard_stats['last_drift_at'] = datetime.utcnow()
+        logger.warning(f"Leaderboard drift corrected ({len(current)} cached vs {len(rows)} in DB)")
+    return drift
+
 def save_chat(chat_id: int, chat_type: str = 'private', title: str = ''):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('INSERT OR IGNORE INTO chats (chat_id, type, title) VALUES (?, ?, ?)', (chat_id, chat_type, title))
-    cur.execute('UPDATE chats SET type = ?, title = ?, last_active = CURRENT_TIMESTAMP WHERE chat_id = ?', (chat_type, title, chat_id))
-    conn.commit()
-    conn.close()
-
-def get_chats(limit: int = 10000):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT chat_id FROM chats LIMIT ?', (limit,))
-    ids = [row[0] for row in cur.fetchall()]
-    conn.close()
-    return ids
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute('INSERT OR IGNORE INTO chats (chat_id, type, title) VALUES (?, ?, ?)', (chat_id, chat_type, title))
+        cur.execute('UPDATE chats SET type = ?, title = ?, last_active = CURRENT_TIMESTAMP, unreachable = 0 WHERE chat_id = ?', (chat_type, title, chat_id))
 
 def add_special_user(user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('INSERT OR IGNORE INTO special_users (user_id) VALUES (?)', (user_id,))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('INSERT OR IGNORE INTO special_users (user_id) VALUES (?)', (user_id,))
+    special_user_ids.add(user_id)
 
 def remove_special_user(user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM special_users WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('DELETE FROM special_users WHERE user_id = ?', (user_id,))
+    special_user_ids.discard(user_id)
 
 def list_special_users():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id FROM special_users ORDER BY user_id')
-    rows = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT user_id FROM special_users ORDER BY user_id')
+        return [r[0] for r in cur.fetchall()]
 
 def is_special_user(user_id: int) -> bool:
-    if user_id in SPECIAL_SET_DEALS_IDS:
-        return True
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT 1 FROM special_users WHERE user_id = ? LIMIT 1', (user_id,))
-    ok = cur.fetchone() is not None
-    conn.close()
-    return ok
+    return user_id in SPECIAL_SET_DEALS_IDS or user_id in special_user_ids
+
+def load_special_users():
+    global special_user_ids
+    # Подменяем set целиком, чтобы параллельные проверки не увидели его пустым
+    special_user_ids = set(list_special_users())
+
+def special_roles_size() -> int:
+    return len(SPECIAL_SET_DEALS_IDS | special_user_ids)
+
+def reload_special_roles():
+    """Полная перезагрузка реестра ролей из JSON и таблицы special_users."""
+    started = time.perf_counter()
+    load_special_admins()
+    load_special_users()
+    special_roles_stats['reloads'] += 1
+    special_roles_stats['last_reload_ms'] = (time.perf_counter() - started) * 1000
+    special_roles_stats['loaded_at'] = datetime.utcnow()
+    logger.info(f"Special roles reloaded: {special_roles_size()} ids in {special_roles_stats['last_reload_ms']:.1f} ms")
 
 # Состояния для FSM
 class Form(StatesGroup):
@@ -423,6 +1097,7 @@ https://t.me/otcgifttg/113382/113404
         ),
         'buy_usage': "❌ <b>Использование:</b> <code>/buy код_мемo</code>",
         'deal_not_found': "❌ <b>Сделка не найдена!</b>",
+        'deal_not_active': "⚠️ <b>Сделка уже оплачена или закрыта.</b>",
         'own_deal_payment': "❌ <b>Вы не можете оплачивать свою сделку!</b>",
         'payment_confirmed_seller': """
 ✅ <b>Оплата прошла успешно! Отправьте в личные сообщения подарок покупателю, и мы отправим вам деньги! 💰</b>
@@ -503,7 +1178,8 @@ Send details in format:
         'enter_amount': "💰 <b>Enter deal amount:</b>\n\nExample: <code>100.5</code>",
         'choose_currency': "🌍 <b>Choose currency for deal:</b>",
         'enter_description': """
-📝 <b>Describe what you offer in the deal:</b>
+📝 <b>Describe what you offer in this deal for {amount} {currency}:</b>
+Example: 10 Caps and Pepe...
 """,
         'deal_created': """
 ✅ <b>Deal created!</b>
@@ -584,6 +1260,7 @@ For any questions contact:
         ),
         'buy_usage': "❌ <b>Usage:</b> <code>/buy memo_code</code>",
         'deal_not_found': "❌ <b>Deal not found!</b>",
+        'deal_not_active': "⚠️ <b>This deal is already paid or closed.</b>",
         'own_deal_payment': "❌ <b>You cannot pay for your own deal!</b>",
         'payment_confirmed_seller': """
 ✅ <b>Payment successful! Send the gift to the buyer in private messages, and we will send you the money! 💰</b>
@@ -611,61 +1288,175 @@ For any questions contact:
     }
 }
 
+# Скомпилированный каталог шаблонов.
+# TEXTS остается исходником для редактирования, а рендер идет по замороженным
+# таблицам: отсутствующие в языке ключи уже подставлены из 'ru', поля
+# форматирования разобраны заранее, а расхождения ключей и плейсхолдеров между
+# языками ловятся при старте, а не KeyError внутри обработчика.
+DEFAULT_LANG = 'ru'
+_formatter = string.Formatter()
+
+def _template_fields(text: str) -> frozenset:
+    return frozenset(field.split('.')[0].split('[')[0]
+                     for _, field, _, _ in _formatter.parse(text) if field)
+
+def _compile_template(text: str):
+    """Разбирает шаблон один раз: ((литерал, поле, conversion, format_spec), ...) или None, если полей нет."""
+    segments = tuple((literal, field, conversion, spec) for literal, field, spec, conversion in _formatter.parse(text))
+    return segments if any(field for _, field, _, _ in segments) else None
+
+def _render_template(segments, kwargs: dict) -> str:
+    parts = []
+    for literal, field, conversion, spec in segments:
+        parts.append(literal)
+        if field is not None:
+            value = kwargs[field] if field.isidentifier() else _formatter.get_field(field, (), kwargs)[0]
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            parts.append(format(value, spec))
+    return ''.join(parts)
+
+class TextCatalog:
+    def __init__(self, texts: dict, default_lang: str = DEFAULT_LANG):
+        self.validate(texts, default_lang)
+        base = texts[default_lang]
+        tables = {}
+        for lang, mapping in texts.items():
+            table = {}
+            for key in base.keys() | mapping.keys():
+                text = mapping.get(key, base.get(key))
+                # Шаблон с полями хранится вместе с разобранными сегментами, без полей — просто строкой
+                table[key] = (text, _compile_template(text))
+            tables[lang] = MappingProxyType(table)
+        self.tables = MappingProxyType(tables)
+        self._default = self.tables[default_lang]
+
+    @staticmethod
+    def validate(texts: dict, default_lang: str = DEFAULT_LANG):
+        errors = []
+        base = texts[default_lang]
+        keys = set().union(*(m.keys() for m in texts.values()))
+        for lang, mapping in texts.items():
+            for key in sorted(keys - mapping.keys()):
+                errors.append(f"{lang}: missing key {key!r}")
+            for key in sorted(mapping.keys() & base.keys()):
+                expected, actual = _template_fields(base[key]), _template_fields(mapping[key])
+                if expected != actual:
+                    errors.append(f"{lang}.{key}: placeholders {sorted(actual)} != {default_lang} {sorted(expected)}")
+        if errors:
+            raise ValueError("TEXTS validation failed:\n" + "\n".join(errors))
+
+    def raw(self, lang: str, key: str) -> str:
+        item = self.tables.get(lang, self._default).get(key)
+        return item[0] if item else key
+
+    def render(self, lang: str, key: str, kwargs: dict = None) -> str:
+        item = self.tables.get(lang, self._default).get(key)
+        if item is None:
+            return key
+        text, segments = item
+        return _render_template(segments, kwargs) if (segments and kwargs) else text
+
+TEXT_CATALOG = None
+
+# Кэш готовых клавиатур: (имя, язык, привилегированный) -> сериализованная разметка
+_keyboard_cache = {}
+
+def invalidate_keyboards():
+    _keyboard_cache.clear()
+
+def update_texts(updates: dict):
+    """Единственный способ менять TEXTS во время работы: {язык: {ключ: текст}}.
+
+    Каталог перекомпилируется с проверкой, кэш клавиатур сбрасывается.
+    """
+    global TEXT_CATALOG
+    merged = {lang: dict(mapping) for lang, mapping in TEXTS.items()}
+    for lang, mapping in updates.items():
+        merged.setdefault(lang, {}).update(mapping)
+    catalog = TextCatalog(merged)
+    for lang, mapping in merged.items():
+        TEXTS.setdefault(lang, {}).update(mapping)
+    TEXT_CATALOG = catalog
+    invalidate_keyboards()
+
 # Дополнительные ключи, которые используются в коде
-TEXTS['ru'].update({
-    'not_added': 'не указано',
-    'not_specified': 'не указано',
-    'user': 'пользователь',
-    'payment_not_allowed': '❌ Оплата не проходит. Напишите в поддержку, что не можете оплатить.',
-    'check_deals': '🧮 Проверка',
-    'your_deals_count': '📊 Ваши успешные сделки: <b>{count}</b>'
-})
-TEXTS['en'].update({
-    'not_added': 'not set',
-    'not_specified': 'not specified',
-    'user': 'user',
-    'payment_not_allowed': '❌ Payment is not allowed. Please contact support that you cannot pay.',
-    'check_deals': '🧮 Check',
-    'your_deals_count': '📊 Your successful deals: <b>{count}</b>'
+update_texts({
+    'ru': {
+        'not_added': 'не указано',
+        'not_specified': 'не указано',
+        'user': 'пользователь',
+        'payment_not_allowed': '❌ Оплата не проходит. Напишите в поддержку, что не можете оплатить.',
+        'check_deals': '🧮 Проверка',
+        'your_deals_count': '📊 Ваши успешные сделки: <b>{count}</b>'
+    },
+    'en': {
+        'not_added': 'not set',
+        'not_specified': 'not specified',
+        'user': 'user',
+        'payment_not_allowed': '❌ Payment is not allowed. Please contact support that you cannot pay.',
+        'check_deals': '🧮 Check',
+        'your_deals_count': '📊 Your successful deals: <b>{count}</b>'
+    },
 })
 
 # Функции для работы с языком
+def load_user_language(user_id):
+    with db.read() as conn:
+        row = conn.execute('SELECT language FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    lang = row[0] if row and row[0] else 'ru'
+    language_cache.add(user_id, lang)
+    return lang
+
 def get_user_language(user_id):
-    user = get_user(user_id)
-    return user[4] if user else 'ru'
+    # В хендлерах кэш уже прогрет ensure_language; чтение из БД — только вне событийного цикла
+    lang = language_cache.get(user_id)
+    if lang is None:
+        lang = load_user_language(user_id)
+    return lang
+
+async def ensure_language(*user_ids):
+    """Прогревает кэш языка через поток БД, чтобы get_text/клавиатуры не читали БД в цикле."""
+    for user_id in user_ids:
+        if language_cache.get(user_id) is None:
+            await run_db(load_user_language, user_id)
+
+def lang_text(lang, text_key):
+    return TEXT_CATALOG.raw(lang, text_key)
 
 def get_text(user_id, text_key, **kwargs):
-    lang = get_user_language(user_id)
-    text = TEXTS[lang].get(text_key, TEXTS['ru'].get(text_key, text_key))
-    return text.format(**kwargs) if kwargs else text
+    return TEXT_CATALOG.render(get_user_language(user_id), text_key, kwargs)
 
-# Inline клавиатуры
-def main_menu_keyboard(user_id):
+# Inline клавиатуры.
+# Клавиатуры зависят только от языка и (для главного меню) от роли, поэтому
+# собираются один раз на вариант и отдаются готовой JSON-строкой: aiogram
+# передает строковый reply_markup в API как есть, без повторной сериализации.
+def _main_menu_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'manage_requisites'), callback_data=menu_cb.new(action="requisites")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'create_deal'), callback_data=menu_cb.new(action="create_deal")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'referral_system'), callback_data=menu_cb.new(action="referral")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'change_language'), callback_data=menu_cb.new(action="language")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'support'), callback_data=menu_cb.new(action="support")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'manage_requisites'), callback_data=menu_cb.new(action="requisites")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'create_deal'), callback_data=menu_cb.new(action="create_deal")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'referral_system'), callback_data=menu_cb.new(action="referral")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'change_language'), callback_data=menu_cb.new(action="language")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'support'), callback_data=menu_cb.new(action="support")))
     # Кнопка проверки сделок — только для спец/супер админов
-    if user_id in ADMIN_IDS or is_special_user(user_id):
-        keyboard.add(InlineKeyboardButton(get_text(user_id, 'check_deals'), callback_data=menu_cb.new(action="check_deals")))
+    if privileged:
+        keyboard.add(InlineKeyboardButton(lang_text(lang, 'check_deals'), callback_data=menu_cb.new(action="check_deals")))
     return keyboard
 
-def back_to_menu_keyboard(user_id):
+def _back_to_menu_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
     return keyboard
 
-def payment_method_keyboard(user_id):
+def _payment_method_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'payment_ton'), callback_data=deal_cb.new(action="ton_wallet")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'payment_card'), callback_data=deal_cb.new(action="bank_card")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'payment_stars'), callback_data=deal_cb.new(action="stars")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'payment_ton'), callback_data=deal_cb.new(action="ton_wallet")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'payment_card'), callback_data=deal_cb.new(action="bank_card")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'payment_stars'), callback_data=deal_cb.new(action="stars")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
     return keyboard
 
-def currency_keyboard(user_id):
+def _currency_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup(row_width=3)
     keyboard.add(
         InlineKeyboardButton("₽ RUB", callback_data=currency_cb.new(code="RUB")),
@@ -681,130 +1472,384 @@ def currency_keyboard(user_id):
         InlineKeyboardButton("$ USD", callback_data=currency_cb.new(code="USD")),
         InlineKeyboardButton("💎 TON", callback_data=currency_cb.new(code="TON"))
     )
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
     return keyboard
 
-def requisites_management_keyboard(user_id):
+def _requisites_management_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'ton_wallet_btn'), callback_data=req_cb.new(action="add_ton")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'card_btn'), callback_data=req_cb.new(action="add_card")))
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'ton_wallet_btn'), callback_data=req_cb.new(action="add_ton")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'card_btn'), callback_data=req_cb.new(action="add_card")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
     return keyboard
 
-def language_keyboard(user_id):
+def _language_markup(lang, privileged):
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
         InlineKeyboardButton("🇷🇺 Русский", callback_data=lang_cb.new(language="ru")),
         InlineKeyboardButton("🇺🇸 English", callback_data=lang_cb.new(language="en"))
     )
-    keyboard.add(InlineKeyboardButton(get_text(user_id, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
+    keyboard.add(InlineKeyboardButton(lang_text(lang, 'back_to_menu'), callback_data=menu_cb.new(action="main_menu")))
     return keyboard
 
 # Reply-клавиатуры для устойчивого FSM без callback
-def method_reply_kb(user_id):
+def _method_reply_markup(lang, privileged):
     return ReplyKeyboardMarkup(
         keyboard=[
-            [KeyboardButton(get_text(user_id, 'payment_ton'))],
-            [KeyboardButton(get_text(user_id, 'payment_card'))],
-            [KeyboardButton(get_text(user_id, 'payment_stars'))],
-            [KeyboardButton(get_text(user_id, 'back_to_menu'))],
+            [KeyboardButton(lang_text(lang, 'payment_ton'))],
+            [KeyboardButton(lang_text(lang, 'payment_card'))],
+            [KeyboardButton(lang_text(lang, 'payment_stars'))],
+            [KeyboardButton(lang_text(lang, 'back_to_menu'))],
         ], resize_keyboard=True
     )
 
-def currency_reply_kb(user_id):
+def _currency_reply_markup(lang, privileged):
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton('RUB'), KeyboardButton('UAH'), KeyboardButton('KZT')],
             [KeyboardButton('BYN'), KeyboardButton('CNY'), KeyboardButton('KGS')],
             [KeyboardButton('USD'), KeyboardButton('TON')],
-            [KeyboardButton(get_text(user_id, 'back_to_menu'))],
+            [KeyboardButton(lang_text(lang, 'back_to_menu'))],
         ], resize_keyboard=True
     )
 
-# Вспомогательные функции
-def get_db_connection():
-    return sqlite3.connect('elf_otc.db')
+# Имя клавиатуры -> (сборщик, зависит ли от роли)
+KEYBOARD_BUILDERS = {
+    'main_menu': (_main_menu_markup, True),
+    'back_to_menu': (_back_to_menu_markup, False),
+    'payment_method': (_payment_method_markup, False),
+    'currency': (_currency_markup, False),
+    'requisites_management': (_requisites_management_markup, False),
+    'language': (_language_markup, False),
+    'method_reply': (_method_reply_markup, False),
+    'currency_reply': (_currency_reply_markup, False),
+}
 
-def get_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
-def create_user(user_id, username, first_name, last_name):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
-                   (user_id, username, first_name, last_name))
-    cursor.execute('UPDATE users SET username = ?, first_name = ?, last_name = ?, last_active = CURRENT_TIMESTAMP WHERE user_id = ?',
-                   (username, first_name, last_name, user_id))
-    conn.commit()
-    conn.close()
+def warm_keyboards():
+    for name, (builder, by_role) in KEYBOARD_BUILDERS.items():
+        for lang in TEXTS:
+            for privileged in ((False, True) if by_role else (False,)):
+                _keyboard_cache[(name, lang, privileged)] = builder(lang, privileged).as_json()
 
-def update_last_active(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+def cached_keyboard(name, lang, privileged=False):
+    key = (name, lang, privileged)
+    markup = _keyboard_cache.get(key)
+    if markup is None:
+        markup = _keyboard_cache[key] = KEYBOARD_BUILDERS[name][0](lang, privileged).as_json()
+    return markup
+
+def main_menu_keyboard(user_id):
+    privileged = user_id in ADMIN_IDS or is_special_user(user_id)
+    return cached_keyboard('main_menu', get_user_language(user_id), privileged)
+
+def back_to_menu_keyboard(user_id):
+    return cached_keyboard('back_to_menu', get_user_language(user_id))
+
+def payment_method_keyboard(user_id):
+    return cached_keyboard('payment_method', get_user_language(user_id))
+
+def currency_keyboard(user_id):
+    return cached_keyboard('currency', get_user_language(user_id))
+
+def requisites_management_keyboard(user_id):
+    return cached_keyboard('requisites_management', get_user_language(user_id))
+
+def language_keyboard(user_id):
+    return cached_keyboard('language', get_user_language(user_id))
+
+def method_reply_kb(user_id):
+    return cached_keyboard('method_reply', get_user_language(user_id))
+
+def currency_reply_kb(user_id):
+    return cached_keyboard('currency_reply', get_user_language(user_id))
+
+# Вспомогательные функции
+def get_user(user_id):
+    with db.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()
 
 def is_banned(user_id) -> bool:
-    user = get_user(user_id)
-    # banned at index 11 (after registered_at)
-    return bool(user[11]) if user and len(user) > 11 else False
+    # banned_users синхронизируется с БД в load_banned_users/set_ban
+    return user_id in banned_users
 
 def set_ban(user_id: int, banned: bool, actor_id: int, reason: str = ''):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET banned = ? WHERE user_id = ?', (1 if banned else 0, user_id))
-    cursor.execute('INSERT INTO logs (actor_id, action, details) VALUES (?, ?, ?)',
-                   (actor_id, 'ban' if banned else 'unban', f'user_id={user_id}; reason={reason}'))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET banned = ? WHERE user_id = ?', (1 if banned else 0, user_id))
+        cursor.execute('INSERT INTO logs (actor_id, action, details) VALUES (?, ?, ?)',
+                       (actor_id, 'ban' if banned else 'unban', f'user_id={user_id}; reason={reason}'))
     # sync in-memory set
     if banned:
         banned_users.add(user_id)
     else:
         banned_users.discard(user_id)
 
+class WriteBehindBuffer(ABC):
+    """Основа буферов отложенной записи в БД.
+
+    Подкласс копит данные в памяти (под self._lock) и реализует _take/_restore/
+    _write_batch/pending. Фоновая задача run() сбрасывает буфер раз в interval
+    секунд или по wake(); flush_sync() — для остановки бота.
+    """
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self.stats = {'flushed': 0, 'batches': 0, 'failures': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+    @abstractmethod
+    def pending(self) -> int:
+        """Сколько записей ждет сброса."""
+
+    @abstractmethod
+    def _take(self):
+        """Забирает накопленное целиком (пустое значение — нечего писать)."""
+
+    @abstractmethod
+    def _restore(self, batch):
+        """Возвращает несохраненную пачку в буфер после ошибки записи."""
+
+    @abstractmethod
+    def _write_batch(self, conn, batch):
+        """Пишет пачку в открытой транзакции писателя."""
+
+    def wake(self):
+        # Можно звать из любого потока
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        with db.write() as conn:
+            self._write_batch(conn, batch)
+        elapsed = (time.perf_counter() - started) * 1000
+        self.stats['flushed'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['last_flush_ms'] = elapsed
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed)
+
+    async def flush(self) -> int:
+        batch = self._take()
+        if batch:
+            try:
+                await run_db(self._write, batch)
+            except Exception:
+                self._restore(batch)
+                self.stats['failures'] += 1
+                raise
+        return len(batch)
+
+    def flush_sync(self) -> int:
+        """Сброс в текущем потоке — для остановки бота."""
+        batch = self._take()
+        if batch:
+            try:
+                self._write(batch)
+            except Exception:
+                self._restore(batch)
+                self.stats['failures'] += 1
+                raise
+        return len(batch)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.exception(f"{self.name} flush failed: {e}")
+        finally:
+            self._loop = None
+
+def _utc_timestamp() -> str:
+    # Тот же формат, что у CURRENT_TIMESTAMP в SQLite
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+# Аудит действий админов пишется не из хендлеров: записи копятся в памяти и
+# сбрасываются одной транзакцией каждые AUDIT_FLUSH_SIZE записей или
+# AUDIT_FLUSH_INTERVAL_MS мс. Время записи фиксируется в момент события.
+# set_ban/set_deal_status по-прежнему пишут лог в своей транзакции — вместе
+# с изменением, которое он описывает.
+AUDIT_FLUSH_SIZE = int(os.getenv('AUDIT_FLUSH_SIZE', '50'))
+AUDIT_FLUSH_INTERVAL_MS = int(os.getenv('AUDIT_FLUSH_INTERVAL_MS', '500'))
+AUDIT_MAX_PENDING = int(os.getenv('AUDIT_MAX_PENDING', '10000'))
+
+class AuditLogWriter(WriteBehindBuffer):
+    """Буфер записей logs с пакетным сбросом. log() не блокируется и безопасен из любого потока."""
+
+    def __init__(self, flush_size: int, interval_ms: int, max_pending: int):
+        super().__init__('Audit log', interval_ms / 1000)
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self._pending = []
+        self.stats['dropped'] = 0
+
+    def log(self, actor_id: int, action: str, details: str = ''):
+        record = (actor_id, action, details, _utc_timestamp())
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) > self.max_pending:
+                # БД недоступна слишком долго: теряем самые старые записи, а не память
+                del self._pending[0]
+                self.stats['dropped'] += 1
+            full = len(self._pending) >= self.flush_size
+        if full:
+            self.wake()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _take(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        return batch
+
+    def _restore(self, batch):
+        with self._lock:
+            self._pending[:0] = batch
+
+    def _write_batch(self, conn, batch):
+        conn.executemany('INSERT INTO logs (actor_id, action, details, created_at) VALUES (?, ?, ?, ?)', batch)
+
+audit_log = AuditLogWriter(AUDIT_FLUSH_SIZE, AUDIT_FLUSH_INTERVAL_MS, AUDIT_MAX_PENDING)
+
 def admin_log(actor_id: int, action: str, details: str = ''):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO logs (actor_id, action, details) VALUES (?, ?, ?)', (actor_id, action, details))
-    conn.commit()
-    conn.close()
+    # Не ждет БД: запись уйдет со следующим сбросом audit_log
+    audit_log.log(actor_id, action, details)
+
+# last_active с точностью до секунды не нужен, а UPDATE+commit на каждое
+# действие пользователя был главным источником конкуренции за писателя.
+# Последнее время активности копится в памяти и сбрасывается раз в
+# ACTIVITY_FLUSH_INTERVAL секунд одной транзакцией; окна активности
+# в get_stats отстают не больше чем на этот интервал.
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5'))
+
+class ActivityBuffer(WriteBehindBuffer):
+    """user_id -> последнее время активности, ждущее записи в users.last_active."""
+
+    def __init__(self, interval: float):
+        super().__init__('Activity', interval)
+        self._dirty = {}
+
+    def touch(self, user_id: int):
+        ts = _utc_timestamp()
+        with self._lock:
+            self._dirty[user_id] = ts
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def _take(self):
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        return batch
+
+    def _restore(self, batch):
+        with self._lock:
+            for user_id, ts in batch.items():
+                if ts > self._dirty.get(user_id, ''):
+                    self._dirty[user_id] = ts
+
+    def _write_batch(self, conn, batch):
+        # Не откатываем время назад, если его уже обновила другая запись (touch_user)
+        conn.executemany('UPDATE users SET last_active = ?1 WHERE user_id = ?2 AND (last_active IS NULL OR last_active < ?1)',
+                         [(ts, user_id) for user_id, ts in batch.items()])
+
+activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL)
+
+def update_last_active(user_id):
+    activity_buffer.touch(user_id)
+
+# Буферы, которые надо сбросить перед закрытием БД
+WRITE_BEHIND_BUFFERS = (audit_log, activity_buffer)
 
 def update_user_ton_wallet(user_id, ton_wallet):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET ton_wallet = ? WHERE user_id = ?', (ton_wallet, user_id))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('UPDATE users SET ton_wallet = ? WHERE user_id = ?', (ton_wallet, user_id))
     logger.info(f"TON wallet updated for user {user_id}: {ton_wallet}")
 
 def update_user_card_details(user_id, card_details):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET card_details = ? WHERE user_id = ?', (card_details, user_id))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('UPDATE users SET card_details = ? WHERE user_id = ?', (card_details, user_id))
     logger.info(f"Card details updated for user {user_id}: {card_details}")
 
+# Последний записанный профиль (username, first_name, last_name, chat_id, type, title)
+# по user_id: повторный /start с теми же данными не пишет в БД вовсе
+profile_cache = TTLCache(LANG_CACHE_SIZE, LANG_CACHE_TTL)
+touch_stats = {'skipped': 0, 'written': 0}
+
+def touch_user(user_id, username, first_name, last_name, chat_id, chat_type, chat_title):
+    """Учет пользователя и чата на /start одной транзакцией (UPSERT).
+
+    Если профиль и чат не изменились с прошлой записи — БД не трогаем, только
+    буферизуем last_active. Возвращает (banned, language).
+    """
+    profile = (username, first_name, last_name, chat_id, chat_type, chat_title)
+    if profile_cache.get(user_id) == profile:
+        touch_stats['skipped'] += 1
+        update_last_active(user_id)
+        return is_banned(user_id), get_user_language(user_id)
+    with db.write() as conn:
+        banned, language = conn.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name, last_active)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+                last_name = excluded.last_name, last_active = CURRENT_TIMESTAMP, unreachable = 0
+            RETURNING banned, language
+        ''', (user_id, username, first_name, last_name)).fetchone()
+        conn.execute('''
+            INSERT INTO chats (chat_id, type, title) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET type = excluded.type, title = excluded.title,
+                last_active = CURRENT_TIMESTAMP, unreachable = 0
+        ''', (chat_id, chat_type, chat_title))
+        # Внутри транзакции: сверка топа не увидит новое имя в БД раньше, чем в памяти
+        leaderboard.rename(user_id, username)
+    touch_stats['written'] += 1
+    language = language or 'ru'
+    profile_cache.set(user_id, profile)
+    language_cache.set(user_id, language)
+    # username мог смениться
+    creator_cache.pop(user_id)
+    return bool(banned), language
+
 def update_user_language(user_id, language):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET language = ? WHERE user_id = ?', (language, user_id))
-    conn.commit()
-    conn.close()
-
-def increment_successful_deals(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET successful_deals = successful_deals + 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        conn.execute('UPDATE users SET language = ? WHERE user_id = ?', (language, user_id))
+    language_cache.set(user_id, language)
+
+def _bump_successful_deals(conn, user_id, delta: int = 1):
+    """+delta к successful_deals внутри открытой транзакции; новое значение или None."""
+    row = conn.execute('UPDATE users SET successful_deals = successful_deals + ? WHERE user_id = ? '
+                       'RETURNING successful_deals, registered_at, username', (delta, user_id)).fetchone()
+    if row:
+        leaderboard.update(user_id, *row)
+        creator_cache.set(user_id, (row[2], row[0]))
+        return row[0]
+    return None
+
+def get_creator_card(user_id):
+    """(username, successful_deals) продавца для карточки сделки или None."""
+    card = creator_cache.get(user_id)
+    if card is None:
+        with db.read() as conn:
+            card = conn.execute('SELECT username, successful_deals FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if card is None:
+            return None
+        card = tuple(card)
+        creator_cache.add(user_id, card)
+    return card
 
 def get_successful_deals_count(user_id):
     user = get_user(user_id)
@@ -813,164 +1858,613 @@ def get_successful_deals_count(user_id):
     return user[9] if user and len(user) > 9 else 0
 
 def set_successful_deals(user_id: int, count: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET successful_deals = ? WHERE user_id = ?', (count, user_id))
-    conn.commit()
-    conn.close()
-
-def get_users(limit=20, offset=0):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, registered_at, banned FROM users ORDER BY registered_at DESC LIMIT ? OFFSET ?', (limit, offset))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with db.write() as conn:
+        row = conn.execute('UPDATE users SET successful_deals = ? WHERE user_id = ? '
+                           'RETURNING successful_deals, registered_at, username', (count, user_id)).fetchone()
+        if row:
+            leaderboard.update(user_id, *row)
+    if row:
+        creator_cache.set(user_id, (row[2], row[0]))
+
+# Keyset-пагинация для списков админки: страница ищется по индексу от курсора
+# (время, id) соседней страницы, поэтому любая страница стоит одинаково —
+# в отличие от OFFSET, который читает и выбрасывает все пропущенные строки.
+# Курсор кодируется компактно, чтобы влезть в 64 байта callback_data.
+_B36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _to_b36(value: int) -> str:
+    if value < 0:
+        return '-' + _to_b36(-value)
+    digits = ''
+    while True:
+        value, rem = divmod(value, 36)
+        digits = _B36[rem] + digits
+        if not value:
+            return digits
+
+def _ts_to_b36(ts) -> str:
+    return _to_b36(int(datetime.strptime(str(ts)[:19], _TS_FORMAT).replace(tzinfo=timezone.utc).timestamp()))
+
+def _b36_to_ts(value: str) -> str:
+    return datetime.fromtimestamp(int(value, 36), tz=timezone.utc).strftime(_TS_FORMAT)
+
+def encode_user_cursor(registered_at, user_id) -> str:
+    return f"{_ts_to_b36(registered_at)}.{_to_b36(user_id)}"
+
+def decode_user_cursor(arg: str):
+    ts, uid = arg.split('.', 1)
+    return _b36_to_ts(ts), int(uid, 36)
+
+def encode_deal_cursor(created_at, deal_id) -> str:
+    return f"{_ts_to_b36(created_at)}.{uuid.UUID(deal_id).hex}"
+
+def decode_deal_cursor(arg: str):
+    ts, hex_id = arg.split('.', 1)
+    return _b36_to_ts(ts), str(uuid.UUID(hex_id))
+
+def keyset_page(conn, sql: str, key: tuple, limit: int, cursor=None, direction: str = 'next'):
+    """Страница в порядке убывания ключа (новые сверху).
+
+    sql — запрос с плейсхолдерами {where} и {order}; key — две колонки ключа.
+    direction='next' — страница старше курсора, 'prev' — новее.
+    Возвращает (rows, есть_новее, есть_старше).
+    """
+    a, b = key
+    if cursor is None:
+        where, order, args = '', f'{a} DESC, {b} DESC', ()
+    elif direction == 'prev':
+        where, order, args = f'WHERE ({a}, {b}) > (?, ?)', f'{a} ASC, {b} ASC', tuple(cursor)
+    else:
+        where, order, args = f'WHERE ({a}, {b}) < (?, ?)', f'{a} DESC, {b} DESC', tuple(cursor)
+    rows = conn.execute(sql.format(where=where, order=order), (*args, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if cursor is not None and direction == 'prev':
+        rows.reverse()
+        return rows, more, True
+    return rows, cursor is not None, more
+
+USERS_PAGE_SQL = 'SELECT user_id, username, registered_at, banned FROM users {where} ORDER BY {order} LIMIT ?'
+ADMIN_USERS_PAGE_SIZE = int(os.getenv('ADMIN_USERS_PAGE_SIZE', '20'))
+
+def get_users(limit=ADMIN_USERS_PAGE_SIZE, cursor=None, direction='next'):
+    with db.read() as conn:
+        return keyset_page(conn, USERS_PAGE_SQL, ('registered_at', 'user_id'), limit, cursor, direction)
+
+# Поиск пользователей через FTS5 (trigram). Триграммам нужно минимум
+# 3 символа — более короткие запросы, а также поиск, пока индекс еще
+# заполняется backfill'ом, идут через LIKE.
+#
+# bm25 требует статистики по всему списку совпадений (на 1М пользователей
+# частая триграмма вроде "Ivan" — ~1 с), поэтому ранжируем сами и только
+# среди USER_SEARCH_CANDIDATES самых новых совпадений плюс точного
+# совпадения username: точное > префикс username > подстрока в username >
+# префикс имени/фамилии > остальное; внутри ранга — новые сверху.
+USER_SEARCH_PAGE_SIZE = 20
+USER_SEARCH_CANDIDATES = 1000
+FTS_MIN_QUERY = 3
+
+FIND_USER_FTS_SQL = """
+    SELECT u.user_id, u.username, u.registered_at, u.banned
+    FROM (
+        SELECT rowid AS id FROM (
+            SELECT rowid FROM users_fts WHERE users_fts MATCH :match ORDER BY rowid DESC LIMIT :candidates
+        )
+        UNION
+        SELECT user_id FROM users WHERE username = :q COLLATE NOCASE
+    ) f
+    JOIN users u ON u.user_id = f.id
+    ORDER BY CASE
+        WHEN u.username = :q COLLATE NOCASE THEN 0
+        WHEN u.username LIKE :prefix THEN 1
+        WHEN u.username LIKE :infix THEN 2
+        WHEN u.first_name LIKE :prefix OR u.last_name LIKE :prefix THEN 3
+        ELSE 4
+    END, u.user_id DESC
+    LIMIT :limit OFFSET :offset
+"""
+
+FIND_USER_LIKE_SQL = """
+    SELECT user_id, username, registered_at, banned
+    FROM users
+    WHERE (username LIKE :infix OR ifnull(first_name,'') LIKE :infix OR ifnull(last_name,'') LIKE :infix)
+    ORDER BY registered_at DESC
+    LIMIT :limit OFFSET :offset
+"""
+
+def user_search_params(query: str, page: int = 0, limit: int = USER_SEARCH_PAGE_SIZE) -> dict:
+    # limit + 1 — чтобы узнать, есть ли следующая страница
+    return {'match': fts_phrase(query), 'candidates': USER_SEARCH_CANDIDATES, 'q': query,
+            'prefix': query + '%', 'infix': f"%{query}%", 'limit': limit + 1, 'offset': page * limit}
+
+def fts_phrase(query: str) -> str:
+    # Запрос как одна фраза: кавычки и операторы FTS5 не интерпретируются
+    return '"' + query.replace('"', '""') + '"'
+
+def users_fts_ready(conn) -> bool:
+    row = conn.execute("SELECT done FROM schema_backfills WHERE name = 'users_fts'").fetchone()
+    return row is None or bool(row[0])
+
+def find_user(query: str, page: int = 0, limit: int = USER_SEARCH_PAGE_SIZE):
+    """Страница результатов поиска: (rows, есть_следующая)."""
+    with db.read() as conn:
+        cursor = conn.cursor()
+        try:
+            # Try by ID
+            uid = int(query)
+            cursor.execute('SELECT user_id, username, registered_at, banned FROM users WHERE user_id = ?', (uid,))
+            row = cursor.fetchone()
+            return ([row] if row else []), False
+        except ValueError:
+            pass
+        use_fts = len(query) >= FTS_MIN_QUERY and users_fts_ready(conn)
+        cursor.execute(FIND_USER_FTS_SQL if use_fts else FIND_USER_LIKE_SQL, user_search_params(query, page, limit))
+        rows = cursor.fetchall()
+        return rows[:limit], len(rows) > limit
 
-def find_user(query: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        # Try by ID
-        uid = int(query)
-        cursor.execute('SELECT user_id, username, registered_at, banned FROM users WHERE user_id = ?', (uid,))
-        row = cursor.fetchone()
-        conn.close()
-        return [row] if row else []
-    except ValueError:
-        pass
-    like = f"%{query}%"
-    cursor.execute(
-        """
-        SELECT user_id, username, registered_at, banned
-        FROM users
-        WHERE (username LIKE ? OR ifnull(first_name,'') LIKE ? OR ifnull(last_name,'') LIKE ?)
-        ORDER BY registered_at DESC
-        LIMIT 20
-        """,
-        (like, like, like)
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+ACTIVE_USERS_SQL = '''
+    SELECT COUNT(DISTINCT user_id) FROM user_activity_daily
+    WHERE day >= date('now', ?) AND last_seen >= datetime('now', ?)
+'''
 
 def get_stats():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM users WHERE last_active >= datetime('now','-1 day')")
-    active_day = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM users WHERE last_active >= datetime('now','-7 day')")
-    active_week = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM deals")
-    total_deals = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM deals WHERE status='active'")
-    active_deals = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM deals WHERE status='completed'")
-    completed_deals = cursor.fetchone()[0]
-    conn.close()
-    return total_users, active_day, active_week, total_deals, active_deals, completed_deals
-
-def list_deals(limit=10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT deal_id, memo_code, creator_id, buyer_id, amount, currency, status, created_at FROM deals ORDER BY created_at DESC LIMIT ?", (limit,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with db.read() as conn:
+        cursor = conn.cursor()
+        # Счетчики поддерживаются триггерами (см. _migration_stats_counters)
+        cursor.execute('SELECT name, value FROM stats_counters')
+        counters = dict(cursor.fetchall())
+        cursor.execute(ACTIVE_USERS_SQL, ('-1 day', '-1 day'))
+        active_day = cursor.fetchone()[0]
+        cursor.execute(ACTIVE_USERS_SQL, ('-7 day', '-7 day'))
+        active_week = cursor.fetchone()[0]
+    return (
+        counters.get('users_total', 0),
+        active_day,
+        active_week,
+        counters.get('deals_total', 0),
+        counters.get('deals_status:active', 0),
+        counters.get('deals_status:completed', 0),
+    )
+
+def prune_activity_rollup():
+    with db.write() as conn:
+        conn.execute("DELETE FROM user_activity_daily WHERE day < date('now', ?)", (f'-{ACTIVITY_ROLLUP_DAYS} day',))
+
+# Размер страницы списка сделок в админке
+ADMIN_DEALS_PAGE_SIZE = int(os.getenv('ADMIN_DEALS_PAGE_SIZE', '10'))
+
+LIST_DEALS_SQL = """
+    SELECT d.deal_id, d.memo_code, d.creator_id, d.buyer_id, d.amount, d.currency, d.status, d.created_at,
+           d.description, s.username, b.username
+    FROM deals d
+    LEFT JOIN users s ON s.user_id = d.creator_id
+    LEFT JOIN users b ON b.user_id = d.buyer_id
+    {where}
+    ORDER BY {order}
+    LIMIT ?
+"""
+
+def list_deals(limit=ADMIN_DEALS_PAGE_SIZE, cursor=None, direction='next'):
+    """Страница сделок вместе с описанием и username продавца/покупателя — одним запросом.
+
+    Возвращает (rows, есть_новее, есть_старше), см. keyset_page.
+    """
+    with db.read() as conn:
+        return keyset_page(conn, LIST_DEALS_SQL, ('d.created_at', 'd.deal_id'), limit, cursor, direction)
+
+def list_completed_deals(limit=10):
+    with db.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT deal_id, memo_code, creator_id, buyer_id, amount, currency, created_at FROM deals WHERE status='completed' ORDER BY completed_at DESC LIMIT ?", (limit,))
+        return cursor.fetchall()
+
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', '90'))
+LOG_ARCHIVE_BATCH = int(os.getenv('LOG_ARCHIVE_BATCH', '5000'))
+LOG_ARCHIVE_INTERVAL = int(os.getenv('LOG_ARCHIVE_INTERVAL', '3600'))
+
+LIST_LOGS_SQL = 'SELECT actor_id, action, details, created_at FROM logs {where} ORDER BY created_at DESC LIMIT ?'
+
+def list_logs(limit=20, actor_id: int = None, action: str = None):
+    """Последние записи логов; фильтры по actor_id/action идут по индексам (фильтр, created_at)."""
+    conditions, args = [], []
+    if actor_id is not None:
+        conditions.append('actor_id = ?')
+        args.append(actor_id)
+    if action:
+        conditions.append('action = ?')
+        args.append(action)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    with db.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(LIST_LOGS_SQL.format(where=where), (*args, limit))
+        return cursor.fetchall()
+
+def log_rollup(days: int = 7, limit: int = 10):
+    """Число записей по action за последние days дней (из logs_daily, включая архивные)."""
+    with db.read() as conn:
+        return conn.execute("""
+            SELECT action, SUM(count) AS total FROM logs_daily
+            WHERE day >= date('now', ?)
+            GROUP BY action ORDER BY total DESC LIMIT ?
+        """, (f'-{days} day', limit)).fetchall()
+
+_ARCHIVE_BATCH_IDS = 'SELECT log_id FROM logs WHERE created_at < ? ORDER BY created_at LIMIT ?'
+
+def archive_logs_batch(retention_days: int = LOG_RETENTION_DAYS, batch_size: int = LOG_ARCHIVE_BATCH) -> int:
+    """Переносит одну пачку записей старше retention_days в logs_archive. Возвращает число перенесенных."""
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    with db.write() as conn:
+        # Оба подзапроса в одной транзакции выбирают одни и те же строки
+        conn.execute(f'INSERT OR REPLACE INTO logs_archive SELECT log_id, actor_id, action, details, created_at '
+                     f'FROM logs WHERE log_id IN ({_ARCHIVE_BATCH_IDS})', (cutoff, batch_size))
+        return conn.execute(f'DELETE FROM logs WHERE log_id IN ({_ARCHIVE_BATCH_IDS})', (cutoff, batch_size)).rowcount
+
+async def archive_old_logs():
+    """Переносит все устаревшие логи пачками, отпуская писателя между ними."""
+    moved = 0
+    while True:
+        batch = await run_db(archive_logs_batch)
+        moved += batch
+        if batch < LOG_ARCHIVE_BATCH:
+            break
+        await asyncio.sleep(BACKFILL_PAUSE)
+    if moved:
+        logger.info(f"Archived {moved} log rows older than {LOG_RETENTION_DAYS} days")
+    return moved
+
+# Аудитория рассылки: keyset-проход по id пачками с фильтрами задачи.
+# Фильтры (dict): lang — язык, active — был активен за N дней, deals — есть
+# сделки; banned / unreachable — включить забаненных / недоступных (по
+# умолчанию они пропускаются). Для чатов действуют только active и unreachable.
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '1000'))
+BROADCAST_FILTERS_RE = re.compile(r'\s*(?:(?:lang=[a-z]{2,8}|active=\d{1,4}|(?:deals|banned|unreachable)=[01])\s*)+')
+
+def parse_broadcast_filters(text: str):
+    """Фильтры из первой строки вида «lang=en active=30 deals=1». Возвращает (фильтры, текст без нее)."""
+    first, _, rest = text.partition('\n')
+    if not BROADCAST_FILTERS_RE.fullmatch(first) or not rest.strip():
+        return {}, text
+    filters = {}
+    for pair in first.split():
+        key, value = pair.split('=', 1)
+        if key == 'lang':
+            filters[key] = value
+        elif int(value):
+            filters[key] = int(value)
+    return filters, rest
+
+def describe_broadcast_filters(filters: dict) -> str:
+    parts = []
+    if filters.get('lang'):
+        parts.append(f"язык {filters['lang']}")
+    if filters.get('active'):
+        parts.append(f"активны за {filters['active']} дн.")
+    if filters.get('deals'):
+        parts.append('со сделками')
+    if filters.get('banned'):
+        parts.append('включая забаненных')
+    if filters.get('unreachable'):
+        parts.append('включая недоступных')
+    return ', '.join(parts) or 'все'
+
+def broadcast_audience_sql(scope: str, filters: dict, select: str):
+    """SELECT по аудитории с условием id > ? первым параметром; возвращает (SQL, параметры после id)."""
+    if scope == 'chats':
+        table, key, conds, params = 'chats', 'chat_id', [], []
+    else:
+        table, key, conds, params = 'users', 'user_id', [], []
+        if filters.get('lang'):
+            conds.append("ifnull(language, 'ru') = ?")
+            params.append(filters['lang'])
+        if not filters.get('banned'):
+            conds.append('NOT ifnull(banned, 0)')
+        if filters.get('deals'):
+            conds.append('(EXISTS (SELECT 1 FROM deals WHERE creator_id = users.user_id) '
+                         'OR EXISTS (SELECT 1 FROM deals WHERE buyer_id = users.user_id))')
+    if filters.get('active'):
+        conds.append("last_active >= datetime('now', ?)")
+        params.append(f"-{int(filters['active'])} day")
+    if not filters.get('unreachable'):
+        conds.append('unreachable = 0')
+    where = ' AND '.join([f'{key} > ?'] + conds)
+    return f'SELECT {select} FROM {table} WHERE {where}', params
+
+def broadcast_recipients_chunk(scope: str, filters: dict, after: int, limit: int = BROADCAST_CHUNK_SIZE):
+    key = 'chat_id' if scope == 'chats' else 'user_id'
+    sql, params = broadcast_audience_sql(scope, filters, key)
+    with db.read() as conn:
+        return [row[0] for row in conn.execute(f'{sql} ORDER BY {key} LIMIT ?', (after, *params, limit))]
+
+def count_broadcast_recipients(scope: str, filters: dict) -> int:
+    sql, params = broadcast_audience_sql(scope, filters, 'COUNT(*)')
+    with db.read() as conn:
+        return conn.execute(sql, (-(2 ** 63), *params)).fetchone()[0]
+
+async def iter_broadcast_recipients(scope: str, filters: dict, after: int = None):
+    """Получатели по возрастанию id после after; в памяти не больше одной пачки."""
+    after = after if after is not None else -(2 ** 63)
+    while True:
+        chunk = await run_db(broadcast_recipients_chunk, scope, filters, after)
+        for chat_id in chunk:
+            yield chat_id
+        if len(chunk) < BROADCAST_CHUNK_SIZE:
+            return
+        after = chunk[-1]
+
+def _mark_unreachable(conn, scope: str, ids):
+    """Помечает получателей недоступными внутри открытой транзакции."""
+    table, key = ('chats', 'chat_id') if scope == 'chats' else ('users', 'user_id')
+    conn.executemany(f'UPDATE {table} SET unreachable = 1 WHERE {key} = ?', [(i,) for i in ids])
 
 def set_deal_status(deal_id: str, status: str, actor_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE deals SET status = ? WHERE deal_id = ?', (status, deal_id))
-    cursor.execute('INSERT INTO logs (actor_id, action, details) VALUES (?, ?, ?)',
-                   (actor_id, 'deal_status', f'deal_id={deal_id}; status={status}'))
-    conn.commit()
-    conn.close()
-
-def backup_db() -> str:
+    with db.write() as conn:
+        cursor = conn.cursor()
+        row = cursor.execute('UPDATE deals SET status = ? WHERE deal_id = ? RETURNING *', (status, deal_id)).fetchone()
+        cursor.execute('INSERT INTO logs (actor_id, action, details) VALUES (?, ?, ?)',
+                       (actor_id, 'deal_status', f'deal_id={deal_id}; status={status}'))
+    cache_deal(row)
+
+# Онлайн-бэкапы через sqlite3 backup API. Копирование идет в отдельном потоке
+# пачками по BACKUP_PAGES_PER_STEP страниц с паузой между ними, со своего
+# соединения с открытой читающей транзакцией: в WAL это целостный снимок,
+# а писатель все это время продолжает работать.
+BACKUP_DIR = os.getenv('BACKUP_DIR', '.')
+BACKUP_PREFIX = 'elf_otc_backup_'
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '256'))
+BACKUP_STEP_PAUSE = float(os.getenv('BACKUP_STEP_PAUSE', '0.005'))
+BACKUP_COMPRESS = os.getenv('BACKUP_COMPRESS', '0') == '1'
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_MAX_AGE_DAYS = float(os.getenv('BACKUP_MAX_AGE_DAYS', '30'))
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '0'))  # 0 — периодические бэкапы выключены
+
+# Один поток: бэкапы не занимают воркеры БД и не идут параллельно друг другу
+_backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+backup_state = {'running': False, 'copied': 0, 'total': 0, 'cancel': False,
+                'last_path': None, 'last_size': 0, 'last_seconds': 0.0, 'last_error': None, 'count': 0}
+
+class BackupCancelled(Exception):
+    pass
+
+def _backup_progress(status, remaining, total):
+    backup_state['copied'] = total - remaining
+    backup_state['total'] = total
+    if backup_state['cancel']:
+        raise BackupCancelled()
+    # Уступаем писателю и остальным потокам между шагами
+    time.sleep(BACKUP_STEP_PAUSE)
+
+def backup_db(compress: bool = BACKUP_COMPRESS) -> str:
+    """Целостная копия базы в BACKUP_DIR, опционально gzip. Возвращает путь к файлу."""
     ts = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-    src = 'elf_otc.db'
-    dst = f'elf_otc_backup_{ts}.db'
-    shutil.copyfile(src, dst)
+    dst = os.path.join(BACKUP_DIR, f'{BACKUP_PREFIX}{ts}.db')
+    tmp = dst + '.part'
+    partial = [tmp]
+    started = time.perf_counter()
+    backup_state.update(running=True, copied=0, total=0, cancel=False, last_error=None)
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        src = sqlite3.connect(DB_PATH, timeout=5.0)
+        target = sqlite3.connect(tmp)
+        try:
+            src.execute('BEGIN')
+            src.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            src.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=_backup_progress)
+            # Копия наследует WAL из заголовка; файл бэкапа должен открываться без -wal/-shm
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            src.close()
+        if compress:
+            dst += '.gz'
+            partial.append(dst)
+            with open(tmp, 'rb') as f_in, gzip.open(dst, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.remove(tmp)
+        else:
+            os.replace(tmp, dst)
+    except BaseException as e:
+        backup_state['last_error'] = repr(e)
+        # Недописанные файлы не оставляем
+        for path in partial:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        backup_state['running'] = False
+    backup_state.update(last_path=dst, last_size=os.path.getsize(dst),
+                        last_seconds=time.perf_counter() - started, count=backup_state['count'] + 1)
+    removed = rotate_backups()
+    logger.info(f"Backup {dst} done in {backup_state['last_seconds']:.1f}s, rotated {len(removed)}")
     return dst
 
+def rotate_backups(keep: int = BACKUP_KEEP, max_age_days: float = BACKUP_MAX_AGE_DAYS):
+    """Оставляет не больше keep последних бэкапов и удаляет старше max_age_days."""
+    files = sorted(glob.glob(os.path.join(BACKUP_DIR, f'{BACKUP_PREFIX}*.db')) +
+                   glob.glob(os.path.join(BACKUP_DIR, f'{BACKUP_PREFIX}*.db.gz')),
+                   key=os.path.getmtime, reverse=True)
+    cutoff = time.time() - max_age_days * 86400
+    removed = []
+    for i, path in enumerate(files):
+        # Самый свежий бэкап не удаляем никогда
+        if i > 0 and (i >= keep or os.path.getmtime(path) < cutoff):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+def cache_deal(row):
+    """Свежая строка сделки после записи — под обоими ключами."""
+    if row:
+        row = tuple(row)
+        deal_cache.set(('id', row[0]), row)
+        deal_cache.set(('memo', row[1]), row)
+
+def _load_deal(column: str, value):
+    with db.read() as conn:
+        row = conn.execute(f'SELECT * FROM deals WHERE {column} = ?', (value,)).fetchone()
+    if row:
+        row = tuple(row)
+        deal_cache.add(('id', row[0]), row)
+        deal_cache.add(('memo', row[1]), row)
+    return row
+
+def load_known_memos():
+    """Пересобирает фильтр известных memo с запасом x2 по емкости."""
+    global known_memos
+    # Под блокировкой записи: create_deal не добавит memo в старый фильтр во время сборки
+    with db.write() as conn:
+        total = conn.execute('SELECT COUNT(*) FROM deals').fetchone()[0]
+        bloom = BloomFilter(max(KNOWN_MEMOS_MIN_CAPACITY, total * 2))
+        for (memo,) in conn.execute('SELECT memo_code FROM deals'):
+            if memo:
+                bloom.add(memo)
+        known_memos = bloom
+    logger.info(f"Known memos loaded: {bloom.count} (capacity {bloom.capacity}, {len(bloom._bits) // 1024} KiB)")
+
+def remember_memo(memo_code: str):
+    known_memos.add(memo_code)
+    if known_memos.count > known_memos.capacity:
+        # Фильтр переполнен — растет доля ложных срабатываний
+        load_known_memos()
+
+def normalize_memo(raw: str) -> str:
+    return (raw or '').strip().lstrip('#').strip().lower()
+
+def memo_may_exist(memo: str) -> bool:
+    """Быстрая проверка без БД: False — такой сделки точно нет."""
+    if not MEMO_RE.fullmatch(memo):
+        memo_filter_stats['bad_format'] += 1
+        return False
+    if memo not in known_memos:
+        memo_filter_stats['unknown'] += 1
+        return False
+    memo_filter_stats['passed'] += 1
+    return True
+
 def create_deal(deal_id, memo_code, creator_id, payment_method, amount, currency, description):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO deals (deal_id, memo_code, creator_id, payment_method, amount, currency, description) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                   (deal_id, memo_code, creator_id, payment_method, amount, currency, description))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        row = conn.execute('INSERT INTO deals (deal_id, memo_code, creator_id, payment_method, amount, currency, description) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING *',
+                           (deal_id, memo_code, creator_id, payment_method, amount, currency, description)).fetchone()
+        # Внутри транзакции записи: пересборка фильтра не пропустит этот memo
+        remember_memo(memo_code)
+    cache_deal(row)
 
 def get_deal_by_id(deal_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM deals WHERE deal_id = ?', (deal_id,))
-    deal = cursor.fetchone()
-    conn.close()
-    return deal
+    return deal_cache.get(('id', deal_id)) or _load_deal('deal_id', deal_id)
 
 def get_deal_by_memo(memo_code):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM deals WHERE memo_code = ?', (memo_code,))
-    deal = cursor.fetchone()
-    conn.close()
+    deal = deal_cache.get(('memo', memo_code)) or _load_deal('memo_code', memo_code)
+    if deal is None:
+        # Хендлеры зовут нас только после memo_may_exist — значит, фильтр ошибся
+        memo_filter_stats['false_positives'] += 1
     return deal
 
 def update_deal_buyer(deal_id, buyer_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE deals SET buyer_id = ? WHERE deal_id = ?', (buyer_id, deal_id))
-    conn.commit()
-    conn.close()
-
-def complete_deal(deal_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE deals SET status = "completed", completed_at = CURRENT_TIMESTAMP WHERE deal_id = ?', (deal_id,))
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        row = conn.execute('UPDATE deals SET buyer_id = ? WHERE deal_id = ? RETURNING *', (buyer_id, deal_id)).fetchone()
+    cache_deal(row)
+
+def complete_deal(deal_id, payer_id):
+    """Оплата сделки одной транзакцией: статус и оба счетчика успешных сделок.
+
+    Срабатывает, только если сделка еще активна, поэтому повторное нажатие
+    ничего не засчитывает. Возвращает (сделки продавца, сделки плательщика)
+    или None, если сделка уже не активна.
+    """
+    with db.write() as conn:
+        row = conn.execute("UPDATE deals SET status = 'completed', completed_at = CURRENT_TIMESTAMP "
+                           "WHERE deal_id = ? AND ifnull(status, 'active') = 'active' RETURNING *",
+                           (deal_id,)).fetchone()
+        if row is None:
+            return None
+        seller_id = row[2]
+        if seller_id == payer_id:
+            # Оплата своей сделки (SELF_PAY_ALLOWED_IDS) засчитывается за обе стороны
+            seller_count = payer_count = _bump_successful_deals(conn, payer_id, 2) or 0
+        else:
+            seller_count = _bump_successful_deals(conn, seller_id) or 0
+            payer_count = _bump_successful_deals(conn, payer_id) or 0
+    # Кэши — после коммита
+    cache_deal(row)
+    return seller_count, payer_count
 
 def add_referral(referrer_id, referred_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Проверяем, что пользователь не пытается перейти по своей ссылке
+    if referrer_id == referred_id:
+        return False
     try:
-        # Проверяем, что пользователь не пытается перейти по своей ссылке
-        if referrer_id == referred_id:
-            return False
-            
-        # Проверяем, что пользователь еще не был рефералом
-        cursor.execute('SELECT * FROM referrals WHERE referred_id = ?', (referred_id,))
-        if cursor.fetchone():
-            return False
-            
-        # Проверяем, что пользователь новый (не совершал сделок)
-        cursor.execute('SELECT successful_deals FROM users WHERE user_id = ?', (referred_id,))
-        user_deals = cursor.fetchone()
-        if user_deals and user_deals[0] > 0:
-            return False  # Пользователь уже пользовался ботом
-            
-        cursor.execute('INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)', (referrer_id, referred_id))
-        cursor.execute('UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?', (referrer_id,))
-        cursor.execute('UPDATE users SET earned_from_referrals = earned_from_referrals + 0.4 WHERE user_id = ?', (referrer_id,))
-        conn.commit()
-        return True
+        with db.write() as conn:
+            cursor = conn.cursor()
+            # Проверяем, что пользователь еще не был рефералом
+            cursor.execute('SELECT * FROM referrals WHERE referred_id = ?', (referred_id,))
+            if cursor.fetchone():
+                return False
+
+            # Проверяем, что пользователь новый (не совершал сделок)
+            cursor.execute('SELECT successful_deals FROM users WHERE user_id = ?', (referred_id,))
+            user_deals = cursor.fetchone()
+            if user_deals and user_deals[0] > 0:
+                return False  # Пользователь уже пользовался ботом
+
+            cursor.execute('INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)', (referrer_id, referred_id))
+            cursor.execute('UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?', (referrer_id,))
+            cursor.execute('UPDATE users SET earned_from_referrals = earned_from_referrals + 0.4 WHERE user_id = ?', (referrer_id,))
+            return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def get_referral_stats(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT referral_count, earned_from_referrals FROM users WHERE user_id = ?', (user_id,))
-    stats = cursor.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT referral_count, earned_from_referrals FROM users WHERE user_id = ?', (user_id,))
+        stats = cursor.fetchone()
     return stats or (0, 0.0)
 
+# Горячие запросы хелперов: имя -> (SQL, параметры) для проверки через EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    'get_stats.active_users': (ACTIVE_USERS_SQL, ('-7 day', '-7 day')),
+    'list_deals': (LIST_DEALS_SQL.format(where='WHERE (d.created_at, d.deal_id) < (?, ?)', order='d.created_at DESC, d.deal_id DESC'),
+                   ('2100-01-01 00:00:00', '', 10)),
+    'list_completed_deals': ("SELECT deal_id, memo_code, creator_id, buyer_id, amount, currency, created_at FROM deals WHERE status='completed' ORDER BY completed_at DESC LIMIT ?", (10,)),
+    'get_users': (USERS_PAGE_SQL.format(where='WHERE (registered_at, user_id) < (?, ?)', order='registered_at DESC, user_id DESC'),
+                  ('2100-01-01 00:00:00', 0, 20)),
+    'find_user': (FIND_USER_FTS_SQL, user_search_params('abc')),
+    'get_top_successful_users': (TOP_SUCCESSFUL_SQL, (LEADERBOARD_SIZE,)),
+    'list_logs': (LIST_LOGS_SQL.format(where=''), (20,)),
+    'list_logs.actor': (LIST_LOGS_SQL.format(where='WHERE actor_id = ?'), (1, 20)),
+    'list_logs.action': (LIST_LOGS_SQL.format(where='WHERE action = ?'), ('set_ban', 20)),
+    'broadcast_recipients': (broadcast_audience_sql('users', {'lang': 'ru', 'active': 30, 'deals': 1}, 'user_id')[0]
+                             + ' ORDER BY user_id LIMIT ?', (0, 'ru', '-30 day', 1000)),
+}
+
+# Шаги плана, ограниченные по размеру конструкцией запроса: find_user сортирует
+# не больше USER_SEARCH_CANDIDATES + 1 строк
+BOUNDED_PLAN_STEPS = {
+    'find_user': ('SCAN f', 'SCAN (subquery-1)', 'TEMP B-TREE FOR ORDER BY'),
+}
+
+def find_table_scans(conn=None):
+    """Возвращает [(имя запроса, строка плана)] для горячих запросов, которые читают таблицу целиком без индекса."""
+    if conn is None:
+        with db.read() as conn:
+            return find_table_scans(conn)
+    offenders = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[-1]
+            if any(step in detail for step in BOUNDED_PLAN_STEPS.get(name, ())):
+                continue
+            # Сюда же попадает частичная досортировка USE TEMP B-TREE FOR RIGHT PART OF ORDER BY
+            if (detail.startswith('SCAN ') and 'INDEX' not in detail) or ('TEMP B-TREE FOR' in detail and 'ORDER BY' in detail):
+                offenders.append((name, detail))
+    return offenders
+
+def check_query_plans():
+    """Проверка для тестов и старта: падает, если какой-то горячий запрос ушел в полный скан."""
+    offenders = find_table_scans()
+    assert not offenders, f"Table scans in hot queries: {offenders}"
+
 async def delete_previous_messages(user_id):
     if user_id in user_messages:
         for msg_id in user_messages[user_id]:
@@ -1032,7 +2526,7 @@ async def send_temp_message(user_id, message_text, reply_markup=None, delete_aft
         asyncio.create_task(_auto_delete(user_id, message.message_id, delete_after))
 
 async def show_requisites_menu(user_id):
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     ton_wallet = user[5] if user and user[5] else get_text(user_id, 'not_added')
     card_details = user[6] if user and user[6] else get_text(user_id, 'not_added')
     
@@ -1047,14 +2541,46 @@ def create_clickable_link(url, text=None):
     return f'<a href="{url}">{text}</a>'
 
 # Обработчики команд
-# Handler that matches any message from banned users (placed early)
-@dp.message_handler(user_id=banned_users)
-async def handle_banned_user_msg(message: types.Message):
-    try:
-        await bot.send_message(message.from_user.id, '⛔ Вы заблокированы. Обратитесь в поддержку.', parse_mode='HTML')
-    except Exception:
-        pass
-    raise CancelHandler()
+BANNED_TEXT = '⛔ Вы заблокированы. Обратитесь в поддержку.'
+# Сколько апдейтов забаненных пользователей отсечено до обработчиков
+ban_stats = {'messages': 0, 'callbacks': 0}
+
+class BanMiddleware(BaseMiddleware):
+    """Отсекает сообщения и callback'и забаненных пользователей до фильтров, обработчиков и БД."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user and message.from_user.id in banned_users:
+            ban_stats['messages'] += 1
+            try:
+                await bot.send_message(message.from_user.id, BANNED_TEXT, parse_mode='HTML')
+            except Exception:
+                pass
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        if call.from_user and call.from_user.id in banned_users:
+            ban_stats['callbacks'] += 1
+            try:
+                await call.answer(BANNED_TEXT, show_alert=True)
+            except Exception:
+                pass
+            raise CancelHandler()
+
+dp.middleware.setup(BanMiddleware())
+
+class LanguageMiddleware(BaseMiddleware):
+    """Прогревает язык отправителя до хендлера: get_text и клавиатуры синхронные."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user:
+            await ensure_language(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        if call.from_user:
+            await ensure_language(call.from_user.id)
+
+dp.middleware.setup(LanguageMiddleware())
+
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.finish()
@@ -1065,18 +2591,16 @@ async def cmd_start(message: types.Message, state: FSMContext):
     first_name = message.from_user.first_name or ""
     last_name = message.from_user.last_name or ""
     
-    create_user(user_id, username, first_name, last_name)
-    # Сохраняем чат
+    # Пользователь и чат — одной транзакцией (или без записи, если ничего не поменялось)
     chat = message.chat
     title = chat.title or (message.from_user.username or message.from_user.first_name or '')
-    save_chat(chat.id, chat.type, title)
-    if is_banned(user_id):
+    banned, _ = await run_db(touch_user, user_id, username, first_name, last_name, chat.id, chat.type, title)
+    if banned:
         try:
-            await bot.send_message(user_id, '⛔ Вы заблокированы. Обратитесь в поддержку.', parse_mode='HTML')
+            await bot.send_message(user_id, BANNED_TEXT, parse_mode='HTML')
         except Exception:
             pass
         return
-    update_last_active(user_id)
     
     # Обработка параметров запуска - реферал/сделка
     args = (message.get_args() or '').strip()
@@ -1088,11 +2612,12 @@ async def cmd_start(message: types.Message, state: FSMContext):
                 if referrer_id == user_id:
                     await send_temp_message(user_id, get_text(user_id, 'self_referral'), delete_after=5)
                 else:
-                    result = add_referral(referrer_id, user_id)
+                    result = await run_db(add_referral, referrer_id, user_id)
                     if result:
                         await send_temp_message(user_id, get_text(user_id, 'ref_joined'), delete_after=5)
                         # Уведомляем реферера
                         try:
+                            await ensure_language(referrer_id)
                             notification_text = get_text(referrer_id, 'referral_bonus_notification', username=username)
                             await bot.send_message(referrer_id, notification_text, parse_mode='HTML')
                         except Exception as e:
@@ -1162,18 +2687,16 @@ async def admin_del_special_state(message: types.Message, state: FSMContext):
     first_name = message.from_user.first_name or ""
     last_name = message.from_user.last_name or ""
     
-    create_user(user_id, username, first_name, last_name)
-    # Сохраняем чат
+    # Пользователь и чат — одной транзакцией (или без записи, если ничего не поменялось)
     chat = message.chat
     title = chat.title or (message.from_user.username or message.from_user.first_name or '')
-    save_chat(chat.id, chat.type, title)
-    if is_banned(user_id):
+    banned, _ = await run_db(touch_user, user_id, username, first_name, last_name, chat.id, chat.type, title)
+    if banned:
         try:
-            await bot.send_message(user_id, '⛔ Вы заблокированы. Обратитесь в поддержку.', parse_mode='HTML')
+            await bot.send_message(user_id, BANNED_TEXT, parse_mode='HTML')
         except Exception:
             pass
         return
-    update_last_active(user_id)
     
     # Обработка параметров запуска - РЕФЕРАЛЬНЫЕ ССЫЛКИ (start)
     args = message.get_args()
@@ -1185,11 +2708,12 @@ async def admin_del_special_state(message: types.Message, state: FSMContext):
                 if referrer_id == user_id:
                     await send_temp_message(user_id, get_text(user_id, 'self_referral'), delete_after=5)
                 else:
-                    result = add_referral(referrer_id, user_id)
+                    result = await run_db(add_referral, referrer_id, user_id)
                     if result:
                         await send_temp_message(user_id, get_text(user_id, 'ref_joined'), delete_after=5)
                         # Уведомляем реферера о новом реферале
                         try:
+                            await ensure_language(referrer_id)
                             notification_text = get_text(referrer_id, 'referral_bonus_notification', username=username)
                             await bot.send_message(referrer_id, notification_text, parse_mode='HTML')
                         except Exception as e:
@@ -1218,7 +2742,7 @@ async def cmd_admin(message: types.Message, state: FSMContext):
     # Регистрируем чат для последующей рассылки по чатам
     chat = message.chat
     title = chat.title or (message.from_user.username or message.from_user.first_name or '')
-    save_chat(chat.id, chat.type, title)
+    await run_db(save_chat, chat.id, chat.type, title)
     update_last_active(user_id)
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -1234,6 +2758,7 @@ async def cmd_admin(message: types.Message, state: FSMContext):
     )
     kb.add(
         InlineKeyboardButton('📡 Рассылка по всем чатам', callback_data=admin_cb.new(section='broadcast', action='allchats', arg='0')),
+        InlineKeyboardButton('🗂 Рассылки', callback_data=admin_cb.new(section='broadcast', action='jobs', arg='0')),
     )
     kb.add(
         InlineKeyboardButton('🧰 Бэкап БД', callback_data=admin_cb.new(section='system', action='backup', arg='0')),
@@ -1256,10 +2781,10 @@ async def cmd_ban(message: types.Message):
     except Exception:
         await send_temp_message(admin_id, 'Укажи корректный ID пользователя: /ban <user_id>')
         return
-    set_ban(target, True, admin_id, reason='cmd')
+    await run_db(set_ban, target, True, admin_id, reason='cmd')
     # Try notifying the user
     try:
-        await bot.send_message(target, '⛔ Вы заблокированы. Обратитесь в поддержку.', parse_mode='HTML')
+        await bot.send_message(target, BANNED_TEXT, parse_mode='HTML')
     except Exception:
         pass
     await send_temp_message(admin_id, f'🚫 Пользователь <code>{target}</code> заблокирован')
@@ -1278,7 +2803,7 @@ async def cmd_unban(message: types.Message):
     except Exception:
         await send_temp_message(admin_id, 'Укажи корректный ID пользователя: /unban <user_id>')
         return
-    set_ban(target, False, admin_id, reason='cmd')
+    await run_db(set_ban, target, False, admin_id, reason='cmd')
     await send_temp_message(admin_id, f'✅ Пользователь <code>{target}</code> разбанен')
 
 @dp.callback_query_handler(admin_cb.filter())
@@ -1293,16 +2818,26 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
     arg = callback_data['arg']
     try:
         if section == 'users':
-            if action == 'list':
-                rows = get_users(limit=20, offset=int(arg))
+            if action in ('list', 'next', 'prev'):
+                cursor = decode_user_cursor(arg) if action != 'list' else None
+                rows, has_newer, has_older = await run_db(get_users, cursor=cursor, direction=action)
                 if not rows:
                     await send_temp_message(user_id, 'Список пуст')
-                text_lines = ['👥 <b>Пользователи</b> (последние 20):']
+                text_lines = [f'👥 <b>Пользователи</b> (по {ADMIN_USERS_PAGE_SIZE}, новые сверху):']
                 for uid, uname, reg, banned in rows:
                     uname = f"@{uname}" if uname else '—'
                     status = '🚫' if banned else '✅'
                     text_lines.append(f"{status} <code>{uid}</code> {uname} • {reg}")
                 kb = InlineKeyboardMarkup(row_width=3)
+                nav = []
+                if rows and has_newer:
+                    nav.append(InlineKeyboardButton('⬅️ Новее', callback_data=admin_cb.new(
+                        section='users', action='prev', arg=encode_user_cursor(rows[0][2], rows[0][0]))))
+                if rows and has_older:
+                    nav.append(InlineKeyboardButton('Старее ➡️', callback_data=admin_cb.new(
+                        section='users', action='next', arg=encode_user_cursor(rows[-1][2], rows[-1][0]))))
+                if nav:
+                    kb.row(*nav)
                 kb.add(
                     InlineKeyboardButton('🔎 Поиск', callback_data=admin_cb.new(section='users', action='search', arg='0')),
                     InlineKeyboardButton('🚫 Бан', callback_data=admin_cb.new(section='users', action='ban', arg='0')),
@@ -1311,7 +2846,13 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
                 await send_main_message(user_id, "\n".join(text_lines), kb)
             elif action == 'search':
                 await Form.admin_user_search.set()
-                await send_temp_message(user_id, 'Введите ID или username для поиска (без @):')
+                await send_temp_message(user_id, 'Введите ID, username или имя для поиска (без @):')
+            elif action == 'found':
+                q = admin_search_queries.get(user_id)
+                if q is None:
+                    await send_temp_message(user_id, 'Поиск устарел, повторите запрос')
+                else:
+                    await send_user_search_page(user_id, q, int(arg))
             elif action == 'ban':
                 await Form.admin_user_ban.set()
                 await send_temp_message(user_id, 'Введите ID пользователя для бана:')
@@ -1319,20 +2860,15 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
                 await Form.admin_user_unban.set()
                 await send_temp_message(user_id, 'Введите ID пользователя для разбана:')
         elif section == 'deals':
-            if action == 'list':
-                rows = list_deals(limit=10)
+            if action in ('list', 'next', 'prev'):
+                cursor = decode_deal_cursor(arg) if action != 'list' else None
+                rows, has_newer, has_older = await run_db(list_deals, cursor=cursor, direction=action)
                 if not rows:
                     await send_temp_message(user_id, 'Сделок нет')
-                lines = ['🤝 <b>Сделки (последние 10)</b>:']
+                lines = [f'🤝 <b>Сделки (по {ADMIN_DEALS_PAGE_SIZE}, новые сверху)</b>:']
                 for d in rows:
-                    deal_id, memo, seller, buyer, amount, currency, status, created = d
-                    # Получаем описание сделки и usernames
-                    deal_full = get_deal_by_id(deal_id)
-                    description = deal_full[7] if deal_full and len(deal_full) > 7 else ''
-                    seller_user = get_user(seller)
-                    buyer_user = get_user(buyer) if buyer else None
-                    seller_un = seller_user[1] if seller_user and seller_user[1] else ''
-                    buyer_un = buyer_user[1] if buyer_user and buyer_user[1] else ''
+                    deal_id, memo, seller, buyer, amount, currency, status, created, description, seller_un, buyer_un = d
+                    description = description or ''
                     seller_tag = f"@{seller_un}" if seller_un else '—'
                     buyer_tag = f"@{buyer_un}" if buyer_un else '—'
                     # Формат: STATUS • <цена> • <товар> • <мемо> • seller=<ID> • <@user> • buyer=<ID> • <@user> • <время>
@@ -1342,6 +2878,15 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
                     )
                     lines.append(line)
                 kb = InlineKeyboardMarkup(row_width=3)
+                nav = []
+                if rows and has_newer:
+                    nav.append(InlineKeyboardButton('⬅️ Новее', callback_data=admin_cb.new(
+                        section='deals', action='prev', arg=encode_deal_cursor(rows[0][7], rows[0][0]))))
+                if rows and has_older:
+                    nav.append(InlineKeyboardButton('Старее ➡️', callback_data=admin_cb.new(
+                        section='deals', action='next', arg=encode_deal_cursor(rows[-1][7], rows[-1][0]))))
+                if nav:
+                    kb.row(*nav)
                 kb.add(
                     InlineKeyboardButton('✔️ Одобрить', callback_data=admin_cb.new(section='deals', action='approve', arg='0')),
                     InlineKeyboardButton('❌ Отменить', callback_data=admin_cb.new(section='deals', action='cancel', arg='0')),
@@ -1352,11 +2897,7 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
                 )
                 await send_main_message(user_id, "\n".join(lines), kb)
             elif action == 'completed':
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute("SELECT deal_id, memo_code, creator_id, buyer_id, amount, currency, created_at FROM deals WHERE status='completed' ORDER BY completed_at DESC LIMIT 10")
-                rows = cur.fetchall()
-                conn.close()
+                rows = await run_db(list_completed_deals, limit=10)
                 if not rows:
                     await send_temp_message(user_id, 'Нет успешных сделок')
                 else:
@@ -1388,9 +2929,24 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
             elif action == 'del':
                 await Form.admin_del_special.set()
                 await send_temp_message(user_id, 'Введите ID для удаления из спец-админов:')
+        # Раньше общей ветки 'stats', иначе до топа не доходило
+        elif section == 'stats' and action == 'leaders':
+            top = await run_db(get_top_successful_users, limit=10)
+            if not top:
+                await send_temp_message(user_id, 'Пока нет успешных сделок')
+            else:
+                lines = ['🏆 <b>Топ пользователей по успешным сделкам</b>:']
+                for i, (uid, uname, cnt) in enumerate(top, start=1):
+                    uname = f"@{uname}" if uname else '—'
+                    lines.append(f"{i}. <code>{uid}</code> {uname} — <b>{cnt}</b>")
+                lines.append(f"\n<i>Сверок с БД: {leaderboard_stats['reconciles']}, "
+                             f"исправлено расхождений: {leaderboard_stats['drift_fixes']}</i>")
+                await send_main_message(user_id, "\n".join(lines))
         elif section == 'stats':
-            stats = get_stats()
+            stats = await run_db(get_stats)
             total_users, active_day, active_week, total_deals, active_deals, completed_deals = stats
+            lang_stats = language_cache.stats()
+            deal_stats = deal_cache.stats()
             txt = (
                 '📊 <b>Статистика</b>\n'
                 f'👥 Пользователей всего: <b>{total_users}</b>\n'
@@ -1398,44 +2954,46 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
                 f'🟡 Активно (7д): <b>{active_week}</b>\n'
                 f'🤝 Сделок всего: <b>{total_deals}</b>\n'
                 f'🔹 Активных сделок: <b>{active_deals}</b>\n'
-                f'✅ Успешных сделок: <b>{completed_deals}</b>'
+                f'✅ Успешных сделок: <b>{completed_deals}</b>\n'
+                f'🗄 Очередь БД: <b>{db_job_stats["pending"]}</b> (пик {db_job_stats["peak"]})\n'
+                f'🧠 Кэш языков: {lang_stats["hits"]} попаданий / {lang_stats["misses"]} промахов\n'
+                f'🔗 Кэш сделок: {deal_stats["hits"]} попаданий / {deal_stats["misses"]} промахов\n'
+                f'🧹 Отсеяно memo: {memo_filter_stats["bad_format"]} мусор / {memo_filter_stats["unknown"]} несуществующих '
+                f'(ложных срабатываний {memo_filter_stats["false_positives"]})\n'
+                f'⛔ Отсечено от забаненных: {ban_stats["messages"]} сообщений / {ban_stats["callbacks"]} callback\n'
+                f'📝 Аудит: в очереди {audit_log.pending()}, сброс {audit_log.stats["last_flush_ms"]:.1f} мс '
+                f'(макс {audit_log.stats["max_flush_ms"]:.1f})\n'
+                f'🕒 Активность: ждут записи {activity_buffer.pending()}, сброс {activity_buffer.stats["last_flush_ms"]:.1f} мс\n'
+                f'📣 Рассылок идет: {len(active_broadcasts)}'
             )
             kb = InlineKeyboardMarkup(row_width=1)
             kb.add(InlineKeyboardButton('🏆 Топ по успешным сделкам', callback_data=admin_cb.new(section='stats', action='leaders', arg='0')))
             await send_main_message(user_id, txt, kb)
-        elif section == 'stats' and action == 'leaders':
-            top = get_top_successful_users(limit=10)
-            if not top:
-                await send_temp_message(user_id, 'Пока нет успешных сделок')
-            else:
-                lines = ['🏆 <b>Топ пользователей по успешным сделкам</b>:']
-                for i, (uid, uname, cnt) in enumerate(top, start=1):
-                    uname = f"@{uname}" if uname else '—'
-                    lines.append(f"{i}. <code>{uid}</code> {uname} — <b>{cnt}</b>")
-                await send_main_message(user_id, "\n".join(lines))
         elif section == 'broadcast' and action == 'start':
             await Form.admin_broadcast.set()
             async with dp.current_state(user=user_id).proxy() as data:
                 data['broadcast_scope'] = 'users'
-            await send_temp_message(user_id, 'Введите текст рассылки (HTML поддерживается):')
+            await send_temp_message(user_id, 'Введите текст рассылки (HTML поддерживается).\n'
+                                             'Фильтры — необязательной первой строкой: '
+                                             '<code>lang=en active=30 deals=1 banned=1 unreachable=1</code>')
         elif section == 'broadcast' and action == 'allchats':
             await Form.admin_broadcast.set()
             async with dp.current_state(user=user_id).proxy() as data:
                 data['broadcast_scope'] = 'chats'
-            await send_temp_message(user_id, 'Введите текст рассылки для всех чатов:')
+            await send_temp_message(user_id, 'Введите текст рассылки для всех чатов.\n'
+                                             'Фильтры — необязательной первой строкой: <code>active=30 unreachable=1</code>')
+        elif section == 'broadcast' and action == 'jobs':
+            await send_broadcast_jobs(user_id)
+        elif section == 'broadcast' and action in ('pause', 'resume', 'cancel'):
+            await send_temp_message(user_id, await control_broadcast(user_id, int(arg), action))
         elif section == 'system' and action == 'backup':
-            path = backup_db()
-            await send_temp_message(user_id, f'✅ Бэкап создан: <code>{path}</code>')
+            if backup_state['running']:
+                await send_temp_message(user_id, '⏳ Бэкап уже выполняется')
+            else:
+                # В фоне: callback отвечает сразу, прогресс приходит отдельным сообщением
+                start_background_task(run_backup(notify_user_id=user_id), 'backup')
         elif section == 'logs' and action == 'list':
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute('SELECT actor_id, action, details, created_at FROM logs ORDER BY created_at DESC LIMIT 20')
-            rows = cur.fetchall()
-            conn.close()
-            lines = ['📜 <b>Логи (последние 20)</b>:']
-            for a, act, det, ts in rows:
-                lines.append(f"{ts} • {a} • {act} • {det}")
-            await send_main_message(user_id, "\n".join(lines))
+            await send_logs(user_id)
     except Exception as e:
         logger.exception(f"admin router error: {e}")
     finally:
@@ -1444,6 +3002,27 @@ async def admin_router(call: types.CallbackQuery, callback_data: dict):
         except Exception:
             pass
 
+# Последний поисковый запрос каждого админа — для кнопок листания результатов
+admin_search_queries = {}
+
+async def send_user_search_page(admin_id: int, q: str, page: int):
+    rows, has_more = await run_db(find_user, q, page)
+    if not rows:
+        await send_temp_message(admin_id, 'Ничего не найдено')
+        return
+    lines = [f'🔎 <b>Результаты поиска</b> (стр. {page + 1}):']
+    for uid, uname, reg, banned in rows:
+        uname = f"@{uname}" if uname else '—'
+        status = '🚫' if banned else '✅'
+        lines.append(f"{status} <code>{uid}</code> {uname} • {reg}")
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=admin_cb.new(section='users', action='found', arg=str(page - 1))))
+    if has_more:
+        nav.append(InlineKeyboardButton('Дальше ➡️', callback_data=admin_cb.new(section='users', action='found', arg=str(page + 1))))
+    kb = InlineKeyboardMarkup().row(*nav) if nav else None
+    await send_main_message(admin_id, "\n".join(lines), kb)
+
 # Admin FSM handlers
 @dp.message_handler(state=Form.admin_user_search)
 async def admin_user_search_state(message: types.Message, state: FSMContext):
@@ -1452,16 +3031,8 @@ async def admin_user_search_state(message: types.Message, state: FSMContext):
         await state.finish()
         return
     q = (message.text or '').strip().lstrip('@')
-    rows = find_user(q)
-    if not rows:
-        await send_temp_message(admin_id, 'Ничего не найдено')
-    else:
-        lines = ['🔎 <b>Результаты поиска</b>:']
-        for uid, uname, reg, banned in rows:
-            uname = f"@{uname}" if uname else '—'
-            status = '🚫' if banned else '✅'
-            lines.append(f"{status} <code>{uid}</code> {uname} • {reg}")
-        await send_main_message(admin_id, "\n".join(lines))
+    admin_search_queries[admin_id] = q
+    await send_user_search_page(admin_id, q, 0)
     await state.finish()
 
 @dp.message_handler(state=Form.admin_user_ban)
@@ -1472,7 +3043,7 @@ async def admin_user_ban_state(message: types.Message, state: FSMContext):
         return
     try:
         target = int((message.text or '').strip())
-        set_ban(target, True, admin_id, reason='manual')
+        await run_db(set_ban, target, True, admin_id, reason='manual')
         await send_temp_message(admin_id, f'🚫 Забанен: <code>{target}</code>')
     except Exception as e:
         await send_temp_message(admin_id, f'Ошибка бана: {e}')
@@ -1486,7 +3057,7 @@ async def admin_user_unban_state(message: types.Message, state: FSMContext):
         return
     try:
         target = int((message.text or '').strip())
-        set_ban(target, False, admin_id, reason='manual')
+        await run_db(set_ban, target, False, admin_id, reason='manual')
         await send_temp_message(admin_id, f'✅ Разбанен: <code>{target}</code>')
     except Exception as e:
         await send_temp_message(admin_id, f'Ошибка разбана: {e}')
@@ -1507,7 +3078,7 @@ async def admin_deal_action_state(message: types.Message, state: FSMContext):
     status_map = {'approve': 'completed', 'cancel': 'cancelled', 'block': 'blocked'}
     status = status_map.get(action, 'completed')
     try:
-        set_deal_status(deal_id, status, admin_id)
+        await run_db(set_deal_status, deal_id, status, admin_id)
         await send_temp_message(admin_id, f'✅ Статус сделки обновлен: {status}')
     except Exception as e:
         await send_temp_message(admin_id, f'Ошибка обновления: {e}')
@@ -1519,37 +3090,12 @@ async def admin_broadcast_state(message: types.Message, state: FSMContext):
     if admin_id not in ADMIN_IDS:
         await state.finish()
         return
-    text = message.html_text or message.text or ''
-    sent = 0
+    filters, text = parse_broadcast_filters(message.html_text or message.text or '')
     async with state.proxy() as data:
         scope = data.get('broadcast_scope', 'users')
-    if scope == 'chats':
-        ids = get_chats()
-        for cid in ids:
-            try:
-                await bot.send_message(cid, text, parse_mode='HTML')
-                sent += 1
-                await asyncio.sleep(0.03)
-            except Exception:
-                continue
-        admin_log(admin_id, 'broadcast_chats', f'sent={sent}')
-        await send_temp_message(admin_id, f'📡 Отправлено по чатам: {sent}')
-    else:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT user_id FROM users')
-        ids = [row[0] for row in cur.fetchall()]
-        conn.close()
-        for uid in ids:
-            try:
-                await bot.send_message(uid, text, parse_mode='HTML')
-                sent += 1
-                await asyncio.sleep(0.03)
-            except Exception:
-                continue
-        admin_log(admin_id, 'broadcast_users', f'sent={sent}')
-        await send_temp_message(admin_id, f'📢 Отправлено пользователям: {sent}')
+    # Рассылка идет фоновой задачей, хендлер админа освобождаем сразу
     await state.finish()
+    await start_broadcast(admin_id, scope, text, filters)
 
 # Специальная команда для установки количества успешных сделок
 @dp.message_handler(commands=['set_my_deals'])
@@ -1569,7 +3115,7 @@ async def cmd_set_my_deals(message: types.Message):
     except Exception:
         await send_temp_message(user_id, 'Ошибка: укажите неотрицательное целое число. Пример: /set_my_deals 35')
         return
-    set_successful_deals(user_id, value)
+    await run_db(set_successful_deals, user_id, value)
     admin_log(user_id, 'set_my_deals', f'value={value}')
     await send_temp_message(user_id, f'✅ Установлено количество успешных сделок: <b>{value}</b>')
 
@@ -1637,7 +3183,7 @@ async def cmd_add_user(message: types.Message):
         return
     try:
         uid = int(args.split()[0])
-        add_special_user(uid)
+        await run_db(add_special_user, uid)
         admin_log(admin_id, 'add_special_user', f'user_id={uid}')
         await send_temp_message(admin_id, f'✅ Добавлен в список: <code>{uid}</code>')
     except Exception as e:
@@ -1654,7 +3200,7 @@ async def cmd_remove_user(message: types.Message):
         return
     try:
         uid = int(args.split()[0])
-        remove_special_user(uid)
+        await run_db(remove_special_user, uid)
         admin_log(admin_id, 'remove_special_user', f'user_id={uid}')
         await send_temp_message(admin_id, f'✅ Удален из списка: <code>{uid}</code>')
     except Exception as e:
@@ -1666,20 +3212,65 @@ async def cmd_list_set_users(message: types.Message):
     if admin_id not in ADMIN_IDS:
         return
     base = sorted(SPECIAL_SET_DEALS_IDS)
-    dyn = list_special_users()
+    dyn = sorted(special_user_ids)
     lines = ['👤 <b>Список спец-пользователей</b>:', '— Базовые (вшитые):']
     lines.append(', '.join([f'<code>{i}</code>' for i in base]) or '—')
     lines.append('— Динамические (из БД):')
     lines.append(', '.join([f'<code>{i}</code>' for i in dyn]) or '—')
     await send_main_message(admin_id, '\n'.join(lines))
 
+@dp.message_handler(commands=['reload_roles'])
+async def cmd_reload_roles(message: types.Message):
+    admin_id = message.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return
+    await run_db(reload_special_roles)
+    admin_log(admin_id, 'reload_roles', f'size={special_roles_size()}')
+    await send_temp_message(
+        admin_id,
+        f'🔄 Роли перезагружены: <b>{special_roles_size()}</b> ID за {special_roles_stats["last_reload_ms"]:.1f} мс'
+    )
+
+async def send_logs(admin_id: int, actor_id: int = None, action: str = None):
+    rows = await run_db(list_logs, limit=20, actor_id=actor_id, action=action)
+    filters = ' '.join(f for f in (f'actor={actor_id}' if actor_id is not None else '', f'action={action}' if action else '') if f)
+    lines = [f'📜 <b>Логи (последние 20{", " + filters if filters else ""})</b>:']
+    for a, act, det, ts in rows:
+        lines.append(f"{ts} • {a} • {act} • {det}")
+    rollup = await run_db(log_rollup, 7)
+    if rollup:
+        lines.append('\n📈 <b>За 7 дней</b>: ' + ', '.join(f"{act or '—'} {cnt}" for act, cnt in rollup))
+    lines.append('\n<i>Фильтр: /logs actor=&lt;id&gt; action=&lt;имя&gt;</i>')
+    await send_main_message(admin_id, "\n".join(lines))
+
+@dp.message_handler(commands=['logs'])
+async def cmd_logs(message: types.Message):
+    admin_id = message.from_user.id
+    if admin_id not in ADMIN_IDS:
+        return
+    actor_id, action = None, None
+    try:
+        for part in (message.get_args() or '').split():
+            key, _, value = part.partition('=')
+            if key == 'actor':
+                actor_id = int(value)
+            elif key == 'action' and value:
+                action = value
+            else:
+                raise ValueError(part)
+    except ValueError:
+        await send_temp_message(admin_id, 'Использование: /logs [actor=&lt;id&gt;] [action=&lt;имя&gt;]')
+        return
+    await send_logs(admin_id, actor_id, action)
+
 # Обработчик для команды pay (для сделок) - удален, так как используем start
 
 # Функция обработки ссылки на сделку
 async def process_deal_link(message: types.Message, memo_code: str):
     user_id = message.from_user.id
     update_last_active(user_id)
-    deal = get_deal_by_memo(memo_code)
+    memo_code = normalize_memo(memo_code)
+    deal = await run_db(get_deal_by_memo, memo_code) if memo_may_exist(memo_code) else None
     
     if not deal:
         await send_temp_message(user_id, get_text(user_id, 'deal_not_found'), delete_after=5)
@@ -1691,11 +3282,12 @@ async def process_deal_link(message: types.Message, memo_code: str):
         await send_temp_message(user_id, get_text(user_id, 'self_deal'), delete_after=5)
         return
     
-    # Обновляем покупателя в сделке
-    update_deal_buyer(deal[0], user_id)
-    creator = get_user(creator_id)
-    creator_name = f"@{creator[1]}" if creator and creator[1] else get_text(user_id, 'user')
-    successful_deals = get_successful_deals_count(creator_id)
+    # Обновляем покупателя в сделке (повторный переход того же покупателя ничего не пишет)
+    if deal[3] != user_id:
+        await run_db(update_deal_buyer, deal[0], user_id)
+    creator = await run_db(get_creator_card, creator_id)
+    creator_name = f"@{creator[0]}" if creator and creator[0] else get_text(user_id, 'user')
+    successful_deals = creator[1] if creator else 0
     
     deal_message = get_text(user_id, 'deal_info',
                             memo_code=deal[1],
@@ -1715,7 +3307,7 @@ async def process_deal_link(message: types.Message, memo_code: str):
         memo = deal[1]
         created_at = deal[9]
         seller_id = creator_id
-        seller_un = creator[1] if creator and creator[1] else ''
+        seller_un = creator[0] if creator and creator[0] else ''
         buyer_id = user_id
         buyer_un = message.from_user.username or ''
         seller_tag = f"@{seller_un}" if seller_un else '—'
@@ -1729,6 +3321,7 @@ async def process_deal_link(message: types.Message, memo_code: str):
     # Уведомляем продавца о присоединении покупателя
     try:
         buyer_username = message.from_user.username or 'user'
+        await ensure_language(creator_id)
         seller_notification = get_text(creator_id, 'buyer_joined_seller', 
                                      username=buyer_username, 
                                      memo_code=deal[1])
@@ -1850,14 +3443,14 @@ async def deal_payment_method_msg(message: types.Message, state: FSMContext):
     if txt == get_text(user_id, 'payment_ton'):
         code = 'ton_wallet'
         # Проверяем наличие TON кошелька
-        user = get_user(user_id)
+        user = await run_db(get_user, user_id)
         if not user or not user[5]:
             await send_temp_message(user_id, get_text(user_id, 'no_ton_wallet'), delete_after=5)
             return
     elif txt == get_text(user_id, 'payment_card'):
         code = 'bank_card'
         # Проверяем наличие карты
-        user = get_user(user_id)
+        user = await run_db(get_user, user_id)
         if not user or not user[6]:
             await send_temp_message(user_id, get_text(user_id, 'no_card_details'), delete_after=5)
             return
@@ -1942,7 +3535,7 @@ async def process_deal_description(message: types.Message, state: FSMContext):
         deal_id = str(uuid.uuid4())
         memo_code = uuid.uuid4().hex[:8]
         
-        create_deal(deal_id, memo_code, user_id, method_code, amount, currency, description)
+        await run_db(create_deal, deal_id, memo_code, user_id, method_code, amount, currency, description)
         
         # Формируем рабочую deep-link ссылку через параметр start (Telegram поддерживает только start/startapp)
         # Используем префикс pay_ чтобы /start корректно показал информацию о сделке
@@ -1967,7 +3560,7 @@ async def referral_callback(call: types.CallbackQuery):
     if not call or not call.from_user:
         return
     user_id = call.from_user.id
-    referral_count, earned = get_referral_stats(user_id)
+    referral_count, earned = await run_db(get_referral_stats, user_id)
     
     # Используем команду start для реферальной ссылки
     referral_url = f"https://t.me/GlftElfOtcRobot_bot?start=ref_{user_id}"
@@ -1997,7 +3590,7 @@ async def check_deals_callback(call: types.CallbackQuery):
     if not (user_id in ADMIN_IDS or is_special_user(user_id)):
         await call.answer()
         return
-    count = get_successful_deals_count(user_id)
+    count = await run_db(get_successful_deals_count, user_id)
     await send_temp_message(user_id, get_text(user_id, 'your_deals_count', count=count))
     await call.answer()
 
@@ -2007,7 +3600,7 @@ async def set_language_callback(call: types.CallbackQuery, callback_data: dict):
         return
     user_id = call.from_user.id
     language = callback_data['language']
-    update_user_language(user_id, language)
+    await run_db(update_user_language, user_id, language)
     await send_temp_message(user_id, get_text(user_id, 'language_changed'), delete_after=3)
     await main_menu_callback(call)
     await call.answer()
@@ -2043,7 +3636,7 @@ async def process_ton_wallet(message: types.Message, state: FSMContext):
         await send_temp_message(user_id, get_text(user_id, 'ton_invalid'), delete_after=5)
         return
     
-    update_user_ton_wallet(user_id, ton_wallet)
+    await run_db(update_user_ton_wallet, user_id, ton_wallet)
     await state.finish()
     await send_temp_message(user_id, get_text(user_id, 'ton_saved'), delete_after=3)
     await show_requisites_menu(user_id)
@@ -2056,7 +3649,7 @@ async def process_card_details(message: types.Message, state: FSMContext):
         await send_temp_message(user_id, get_text(user_id, 'card_invalid'), delete_after=5)
         return
     
-    update_user_card_details(user_id, raw)
+    await run_db(update_user_card_details, user_id, raw)
     await state.finish()
     await send_temp_message(user_id, get_text(user_id, 'card_saved'), delete_after=3)
     await show_requisites_menu(user_id)
@@ -2070,8 +3663,8 @@ async def cmd_buy(message: types.Message):
         await send_temp_message(user_id, get_text(user_id, 'buy_usage'), delete_after=5)
         return
     
-    memo = args.lstrip('#').strip()
-    deal = get_deal_by_memo(memo)
+    memo = normalize_memo(args)
+    deal = await run_db(get_deal_by_memo, memo) if memo_may_exist(memo) else None
     if not deal:
         await send_temp_message(user_id, get_text(user_id, 'deal_not_found'), delete_after=5)
         return
@@ -2088,22 +3681,19 @@ async def cmd_buy(message: types.Message):
             await send_temp_message(user_id, get_text(user_id, 'payment_not_allowed'))
             return
     
-    # Подтверждаем оплату
-    complete_deal(deal[0])
-    
-    # Увеличиваем счетчик успешных сделок для обоих участников
-    increment_successful_deals(creator_id)  # Продавец
-    increment_successful_deals(user_id)     # Покупатель
+    # Подтверждаем оплату и увеличиваем счетчики обоих участников — одной транзакцией
+    counts = await run_db(complete_deal, deal[0], user_id)
+    if counts is None:
+        await send_temp_message(user_id, get_text(user_id, 'deal_not_active'), delete_after=5)
+        return
+    seller_deals_count, buyer_deals_count = counts
     
     amount, currency, description = deal[5], deal[6], deal[7]
     buyer_username = message.from_user.username or 'user'
     
-    # Получаем актуальные счетчики сделок
-    seller_deals_count = get_successful_deals_count(creator_id)
-    buyer_deals_count = get_successful_deals_count(user_id)
-    
     # Сообщение продавцу
     try:
+        await ensure_language(creator_id)
         seller_message = get_text(creator_id, 'payment_confirmed_seller', 
                                 memo_code=memo, 
                                 username=buyer_username, 
@@ -2126,8 +3716,13 @@ async def cmd_buy(message: types.Message):
 
 # Инициализация базы данных
 init_db()
-load_special_admins()
+warm_keyboards()
+for _name, _detail in find_table_scans():
+    logger.warning(f"Query plan regression in {_name}: {_detail}")
+reload_special_roles()
 load_banned_users()
+load_leaderboard()
+load_known_memos()
 
 # Настройки вебхука из окружения
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').strip()
@@ -2136,16 +3731,513 @@ WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
 _render_port = os.getenv('PORT')
 WEBAPP_PORT = int(_render_port) if _render_port else int(os.getenv('WEBAPP_PORT', '8080'))
 
+# Фоновые задачи бота: запускаются при старте, останавливаются при завершении
+_background_tasks = set()
+
+def start_background_task(coro, name: str):
+    async def _guarded():
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Background task {name} failed: {e}")
+    task = asyncio.create_task(_guarded(), name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def run_periodic(func, interval: float, name: str):
+    """Периодически выполняет синхронный DB-хелпер в потоке БД (или корутинную функцию)."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if asyncio.iscoroutinefunction(func):
+                await func()
+            else:
+                await run_db(func)
+        except Exception as e:
+            logger.exception(f"Periodic job {name} failed: {e}")
+
+async def start_background_jobs():
+    for buffer in WRITE_BEHIND_BUFFERS:
+        start_background_task(buffer.run(), buffer.name)
+    start_background_task(run_pending_backfills(), 'backfills')
+    start_background_task(resume_broadcasts(), 'broadcast_resume')
+    start_background_task(run_periodic(prune_activity_rollup, 3600, 'activity_rollup'), 'activity_rollup')
+    start_background_task(run_periodic(reconcile_leaderboard, LEADERBOARD_RECONCILE_INTERVAL, 'leaderboard'), 'leaderboard')
+    start_background_task(archive_old_logs(), 'logs_archive_startup')
+    start_background_task(run_periodic(archive_old_logs, LOG_ARCHIVE_INTERVAL, 'logs_archive'), 'logs_archive')
+    if BACKUP_INTERVAL > 0:
+        start_background_task(run_periodic_backups(BACKUP_INTERVAL), 'backups')
+
+async def run_backup(notify_user_id: int = None):
+    """Бэкап в отдельном потоке; админу, запустившему его, — живой прогресс."""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_backup_executor, backup_db)
+    progress_msg = None
+    if notify_user_id:
+        progress_msg = await bot.send_message(notify_user_id, '🧰 Бэкап: запуск…')
+    shown = None
+    while not future.done():
+        await asyncio.wait({future}, timeout=2)
+        total = backup_state['total']
+        if progress_msg and total and not future.done():
+            text = f"🧰 Бэкап: {backup_state['copied'] * 100 // total}% ({backup_state['copied']}/{total} стр.)"
+            if text != shown:
+                shown = text
+                try:
+                    await progress_msg.edit_text(text)
+                except Exception:
+                    pass
+    try:
+        path = future.result()
+    except Exception as e:
+        logger.exception(f"Backup failed: {e}")
+        text = f'❌ Бэкап не удался: {e!r}'
+    else:
+        text = (f"✅ Бэкап создан: <code>{path}</code>\n"
+                f"{backup_state['last_size'] / 1048576:.1f} МБ за {backup_state['last_seconds']:.1f} с")
+    if progress_msg:
+        try:
+            await progress_msg.edit_text(text, parse_mode='HTML')
+        except Exception:
+            await send_temp_message(notify_user_id, text)
+
+async def run_periodic_backups(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        if backup_state['running']:
+            continue
+        try:
+            await run_backup()
+        except Exception as e:
+            logger.exception(f"Periodic backup failed: {e}")
+
+# Рассылки: пул из BROADCAST_WORKERS воркеров, общий для всех рассылок лимит
+# отправки (глобальный token bucket + интервал на чат по лимитам Telegram:
+# ~30 сообщений/с на бота, 1/с в личку, 20/мин в группу) и пауза всего пула по RetryAfter.
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_PRIVATE_INTERVAL = float(os.getenv('BROADCAST_PRIVATE_INTERVAL', '1'))
+BROADCAST_GROUP_INTERVAL = float(os.getenv('BROADCAST_GROUP_INTERVAL', '3'))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', '5'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv('BROADCAST_CHECKPOINT_INTERVAL', '1'))
+BROADCAST_LOGGED_ERRORS = 3  # сколько примеров каждой ошибки писать в лог
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, запас до capacity.
+
+    По умолчанию запас в один токен — ровный темп без всплесков на старте.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Ждущие обслуживаются по очереди, без гонки за токены
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Никому не выдавать токены seconds секунд и не копить запас за паузу."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0
+            self._updated = until
+
+class SendLimiter:
+    """Глобальный token bucket плюс минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, rate: float, private_interval: float, group_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self._next_send = {}
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        if len(self._next_send) > 10000:
+            self._next_send = {k: v for k, v in self._next_send.items() if v > now}
+        interval = self.private_interval if chat_id > 0 else self.group_interval
+        slot = max(now, self._next_send.get(chat_id, 0.0))
+        self._next_send[chat_id] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+
+broadcast_limiter = SendLimiter(BROADCAST_RATE, BROADCAST_PRIVATE_INTERVAL, BROADCAST_GROUP_INTERVAL)
+
+BROADCAST_JOB_COLUMNS = 'job_id, admin_id, scope, text, status, cursor, total, sent, failed, errors, filters'
+BROADCAST_STATUS_TITLES = {'running': '⏳ идет', 'paused': '⏸ на паузе', 'done': '✅ завершена', 'cancelled': '✖️ отменена'}
+
+def create_broadcast_job(admin_id: int, scope: str, text: str, total: int, filters: dict):
+    with db.write() as conn:
+        return tuple(conn.execute(f'INSERT INTO broadcast_jobs (admin_id, scope, text, total, filters) VALUES (?, ?, ?, ?, ?) '
+                                  f'RETURNING {BROADCAST_JOB_COLUMNS}',
+                                  (admin_id, scope, text, total, json.dumps(filters))).fetchone())
+
+def list_broadcast_jobs(limit: int = 10):
+    with db.read() as conn:
+        return conn.execute(f'SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs ORDER BY job_id DESC LIMIT ?',
+                            (limit,)).fetchall()
+
+def running_broadcast_jobs():
+    with db.read() as conn:
+        return conn.execute(f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status = 'running' "
+                            f"ORDER BY job_id").fetchall()
+
+def set_broadcast_job_status(job_id: int, status: str, from_statuses: tuple):
+    """Меняет статус, только если текущий входит в from_statuses. Возвращает строку задачи или None."""
+    marks = ', '.join('?' * len(from_statuses))
+    with db.write() as conn:
+        return conn.execute(f'UPDATE broadcast_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP, '
+                            f"finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END "
+                            f'WHERE job_id = ? AND status IN ({marks}) RETURNING {BROADCAST_JOB_COLUMNS}',
+                            (status, status, job_id, *from_statuses)).fetchone()
+
+def save_broadcast_checkpoint(snapshot: tuple, scope: str = None, unreachable=()):
+    """Курсор, счетчики и статус из BroadcastJob.snapshot() вместе с отметками недоступных — одной транзакцией."""
+    status, cursor, sent, failed, errors, job_id = snapshot
+    with db.write() as conn:
+        if unreachable:
+            _mark_unreachable(conn, scope, unreachable)
+        conn.execute('UPDATE broadcast_jobs SET status = ?, cursor = ?, sent = ?, failed = ?, errors = ?, '
+                     'updated_at = CURRENT_TIMESTAMP, '
+                     "finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END "
+                     'WHERE job_id = ?', (status, cursor, sent, failed, errors, status, job_id))
+
+class BroadcastJob:
+    """Рассылка из broadcast_jobs: счетчики для прогресса и курсор для продолжения.
+
+    Получатели идут по возрастанию id, а воркеры завершают их вразнобой.
+    Курсор — последний id, до которого включительно все получатели
+    обработаны; счетчики считаются по тому же префиксу, поэтому сохраненная
+    пара (курсор, счетчики) всегда согласована.
+    """
+
+    def __init__(self, row):
+        (self.id, self.admin_id, self.scope, self.text, self.status, self.cursor,
+         self.total, self.sent, self.failed, errors, filters) = row
+        self.errors = json.loads(errors) if errors else {}
+        self.filters = json.loads(filters) if filters else {}
+        # Получатели, которым больше не доставить; уходят в БД с ближайшим чекпоинтом
+        self.unreachable = []
+        self.retry_after = 0
+        self.started = time.monotonic()
+        self.done_at_start = self.sent + self.failed
+        self.finished = None
+        # id получателя -> None, пока в работе, или (причина ошибки | None,) — в порядке выдачи
+        self._inflight = OrderedDict()
+        self._logged = {}
+
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    def remaining(self) -> int:
+        return max(0, self.total - self.done())
+
+    def eta(self):
+        elapsed = time.monotonic() - self.started
+        done = self.done() - self.done_at_start
+        if done <= 0 or elapsed <= 0:
+            return None
+        return self.remaining() / (done / elapsed)
+
+    def dispatch(self, chat_id: int):
+        self._inflight[chat_id] = None
+
+    def complete(self, chat_id: int, reason: str = None):
+        self._inflight[chat_id] = (reason,)
+        # Курсор двигается только по непрерывному префиксу обработанных
+        while self._inflight:
+            first, result = next(iter(self._inflight.items()))
+            if result is None:
+                break
+            self._inflight.popitem(last=False)
+            self.cursor = first
+            if result[0] is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.errors[result[0]] = self.errors.get(result[0], 0) + 1
+
+    def fail(self, chat_id: int, reason: str, error=None):
+        self._logged[reason] = self._logged.get(reason, 0) + 1
+        if self._logged[reason] <= BROADCAST_LOGGED_ERRORS:
+            logger.warning(f"Broadcast #{self.id}: {chat_id} failed: {reason} {error or ''}")
+        self.complete(chat_id, reason)
+
+    def snapshot(self) -> tuple:
+        return self.status, self.cursor, self.sent, self.failed, json.dumps(self.errors), self.id
+
+    def errors_summary(self) -> str:
+        return ', '.join(f'{reason}={count}' for reason, count in
+                         sorted(self.errors.items(), key=lambda item: -item[1]))
+
+active_broadcasts = {}
+
+def _format_duration(seconds) -> str:
+    if seconds is None:
+        return '—'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}ч {seconds % 3600 // 60:02d}м'
+    return f'{seconds // 60}м {seconds % 60:02d}с'
+
+def broadcast_progress_text(job: BroadcastJob) -> str:
+    title = '📡 Рассылка по чатам' if job.scope == 'chats' else '📢 Рассылка пользователям'
+    text = (f'{title} #{job.id} — {BROADCAST_STATUS_TITLES.get(job.status, job.status)}\n'
+            f'Получатели: {describe_broadcast_filters(job.filters)}\n'
+            f'Обработано {job.done()}/{job.total}: ✅ {job.sent} · ❌ {job.failed} · осталось {job.remaining()}')
+    if job.status == 'running':
+        text += f'\nETA: {_format_duration(job.eta())}'
+    elif job.finished is not None:
+        text += f'\nЭтот запуск: {_format_duration(job.finished - job.started)}'
+    if job.errors:
+        text += f'\n{job.errors_summary()}'
+    if job.retry_after:
+        text += f'\n🐢 Флуд-контроль: {job.retry_after} раз'
+    return text
+
+def broadcast_job_keyboard(job_id: int, status: str):
+    kb = InlineKeyboardMarkup(row_width=2)
+    cancel = InlineKeyboardButton('✖️ Отменить', callback_data=admin_cb.new(section='broadcast', action='cancel', arg=str(job_id)))
+    if status == 'running':
+        kb.add(InlineKeyboardButton('⏸ Пауза', callback_data=admin_cb.new(section='broadcast', action='pause', arg=str(job_id))), cancel)
+    elif status == 'paused':
+        kb.add(InlineKeyboardButton('▶️ Продолжить', callback_data=admin_cb.new(section='broadcast', action='resume', arg=str(job_id))), cancel)
+    return kb
+
+async def _send_broadcast_message(job: BroadcastJob, chat_id: int):
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        await broadcast_limiter.wait(chat_id)
+        try:
+            await bot.send_message(chat_id, job.text, parse_mode='HTML')
+            job.complete(chat_id)
+            return
+        except RetryAfter as e:
+            # Лимит на бота: останавливаем весь пул, а не только этого воркера
+            job.retry_after += 1
+            broadcast_limiter.pause(e.timeout)
+            logger.warning(f"Broadcast #{job.id}: flood control, pausing {e.timeout}s")
+            error = e
+        except NetworkError as e:
+            await asyncio.sleep(attempt)
+            error = e
+        except TelegramAPIError as e:
+            # Заблокировал бота, чат не найден и т.п. — повтор не поможет
+            if isinstance(e, (Unauthorized, ChatNotFound)):
+                job.unreachable.append(chat_id)
+            job.fail(chat_id, type(e).__name__, e)
+            return
+        except Exception as e:
+            job.fail(chat_id, type(e).__name__, e)
+            return
+    job.fail(chat_id, 'TooManyAttempts', error)
+
+async def _broadcast_checkpoints(job: BroadcastJob, progress_msg):
+    """Сохраняет курсор раз в BROADCAST_CHECKPOINT_INTERVAL, прогресс у админа обновляет реже."""
+    saved = shown = None
+    next_progress = time.monotonic() + BROADCAST_PROGRESS_INTERVAL
+    while True:
+        await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+        snapshot = job.snapshot()
+        unreachable, job.unreachable = job.unreachable, []
+        if snapshot != saved or unreachable:
+            try:
+                await run_db(save_broadcast_checkpoint, snapshot, job.scope, unreachable)
+                saved = snapshot
+            except Exception as e:
+                job.unreachable.extend(unreachable)
+                logger.exception(f"Broadcast #{job.id}: checkpoint failed: {e}")
+            else:
+                # Следующий /start снимет отметку: профиль запишется в БД заново
+                for chat_id in unreachable:
+                    profile_cache.pop(chat_id)
+        if progress_msg and time.monotonic() >= next_progress:
+            next_progress = time.monotonic() + BROADCAST_PROGRESS_INTERVAL
+            text = broadcast_progress_text(job)
+            if text != shown:
+                shown = text
+                try:
+                    await progress_msg.edit_text(text, reply_markup=broadcast_job_keyboard(job.id, job.status))
+                except Exception:
+                    pass
+
+async def run_broadcast(job: BroadcastJob):
+    """Отправляет job.text получателям после job.cursor, пока задача в статусе running.
+
+    Пауза и отмена меняют job.status: новые получатели больше не выдаются,
+    уже взятые в очередь пропускаются и остаются за курсором.
+    """
+    active_broadcasts[job.id] = job
+    progress_msg = None
+    helpers = []
+    recipients = iter_broadcast_recipients(job.scope, job.filters, job.cursor)
+    try:
+        try:
+            progress_msg = await bot.send_message(job.admin_id, broadcast_progress_text(job),
+                                                  reply_markup=broadcast_job_keyboard(job.id, job.status))
+        except Exception as e:
+            logger.warning(f"Broadcast #{job.id}: cannot show progress: {e}")
+        queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if job.status == 'running':
+                        await _send_broadcast_message(job, chat_id)
+                finally:
+                    queue.task_done()
+
+        helpers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+        helpers.append(asyncio.create_task(_broadcast_checkpoints(job, progress_msg)))
+        async for chat_id in recipients:
+            if job.status != 'running':
+                break
+            job.dispatch(chat_id)
+            await queue.put(chat_id)
+        await queue.join()
+        if job.status == 'running':
+            job.status = 'done'
+    finally:
+        await recipients.aclose()
+        for task in helpers:
+            task.cancel()
+        await asyncio.gather(*helpers, return_exceptions=True)
+        # В потоке БД, как и остальные записи; shield — чтобы при остановке бота
+        # отмена задачи не оборвала сохранение курсора
+        try:
+            await asyncio.shield(run_db(save_broadcast_checkpoint, job.snapshot(), job.scope, job.unreachable))
+            job.unreachable = []
+        except Exception as e:
+            logger.exception(f"Broadcast #{job.id}: final checkpoint failed: {e}")
+        finally:
+            # Пока курсор не сохранен, «Продолжить» должно видеть задачу как выполняющуюся
+            active_broadcasts.pop(job.id, None)
+    job.finished = time.monotonic()
+    logger.info(f"Broadcast #{job.id} {job.status}: sent={job.sent} failed={job.failed} {job.errors_summary()}")
+    if job.status != 'paused':
+        details = f'job_id={job.id}; status={job.status}; sent={job.sent}; failed={job.failed}'
+        if job.errors:
+            details += f'; {job.errors_summary()}'
+        admin_log(job.admin_id, f'broadcast_{job.scope}', details)
+    text = broadcast_progress_text(job)
+    try:
+        await progress_msg.edit_text(text, reply_markup=broadcast_job_keyboard(job.id, job.status))
+    except Exception:
+        # Нет сообщения с прогрессом или его уже не отредактировать
+        await send_temp_message(job.admin_id, text, reply_markup=broadcast_job_keyboard(job.id, job.status))
+
+def start_broadcast_job(job: BroadcastJob):
+    start_background_task(run_broadcast(job), f'broadcast-{job.id}')
+
+async def start_broadcast(admin_id: int, scope: str, text: str, filters: dict = None) -> BroadcastJob:
+    filters = filters or {}
+    if scope == 'chats':
+        filters = {key: value for key, value in filters.items() if key in ('active', 'unreachable')}
+    total = await run_db(count_broadcast_recipients, scope, filters)
+    job = BroadcastJob(await run_db(create_broadcast_job, admin_id, scope, text, total, filters))
+    start_broadcast_job(job)
+    return job
+
+async def resume_broadcasts():
+    """После рестарта продолжает незавершенные рассылки с последнего сохраненного курсора."""
+    for row in await run_db(running_broadcast_jobs):
+        if row[0] not in active_broadcasts:
+            logger.info(f"Resuming broadcast #{row[0]} after cursor {row[5]}")
+            start_broadcast_job(BroadcastJob(row))
+
+async def control_broadcast(admin_id: int, job_id: int, action: str) -> str:
+    """Пауза, продолжение и отмена из админки. Возвращает текст ответа админу."""
+    job = active_broadcasts.get(job_id)
+    if action == 'resume':
+        if job:
+            return f'⏳ Рассылка #{job_id} еще выполняется'
+        row = await run_db(set_broadcast_job_status, job_id, 'running', ('paused',))
+        if not row:
+            return f'Рассылку #{job_id} нельзя продолжить'
+        start_broadcast_job(BroadcastJob(row))
+        reply = f'▶️ Рассылка #{job_id} продолжена'
+    else:
+        status = 'paused' if action == 'pause' else 'cancelled'
+        if job and job.status == 'running':
+            # Воркеры заметят статус сами; курсор и итог сохранит run_broadcast
+            job.status = status
+        elif job or not await run_db(set_broadcast_job_status, job_id, status,
+                                     ('running',) if action == 'pause' else ('running', 'paused')):
+            return f'Рассылку #{job_id} нельзя {"приостановить" if action == "pause" else "отменить"}'
+        reply = f'⏸ Рассылка #{job_id} ставится на паузу' if action == 'pause' else f'✖️ Рассылка #{job_id} отменена'
+    admin_log(admin_id, f'broadcast_{action}', f'job_id={job_id}')
+    return reply
+
+async def send_broadcast_jobs(admin_id: int):
+    rows = await run_db(list_broadcast_jobs)
+    if not rows:
+        await send_temp_message(admin_id, 'Рассылок еще не было')
+        return
+    lines = ['🗂 <b>Рассылки</b> (последние 10):']
+    kb = InlineKeyboardMarkup(row_width=2)
+    for job_id, _admin_id, scope, _text, status, _cursor, total, sent, failed, _errors, _filters in rows:
+        job = active_broadcasts.get(job_id)
+        if job:
+            status, sent, failed = job.status, job.sent, job.failed
+        where = 'чаты' if scope == 'chats' else 'пользователи'
+        lines.append(f'#{job_id} {where}: {BROADCAST_STATUS_TITLES.get(status, status)}, '
+                     f'✅ {sent} · ❌ {failed} из {total}')
+        if status in ('running', 'paused'):
+            for button in broadcast_job_keyboard(job_id, status).inline_keyboard[0]:
+                button.text = f'{button.text} #{job_id}'
+                kb.insert(button)
+    await send_main_message(admin_id, '\n'.join(lines), kb)
+
+async def stop_background_jobs():
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # Остатки буферов пишем синхронно, до закрытия БД
+    for buffer in WRITE_BEHIND_BUFFERS:
+        try:
+            buffer.flush_sync()
+        except Exception as e:
+            logger.exception(f"Final {buffer.name} flush failed: {e}")
+
 async def on_startup_webhook(dp: Dispatcher):
     if WEBHOOK_URL:
         await bot.set_webhook(WEBHOOK_URL)
         logger.info(f"Webhook set to {WEBHOOK_URL}")
+    await start_background_jobs()
 
 async def on_shutdown_webhook(dp: Dispatcher):
     try:
         await bot.delete_webhook()
     except Exception:
         pass
+    await stop_background_jobs()
+    shutdown_db()
 
 # Мини-вебсервер для режима polling, чтобы Render видел открытый порт
 async def _health_app_factory():
@@ -2177,6 +4269,11 @@ async def on_startup_polling(dp: Dispatcher):
         logger.info(f"Health server started on http://{WEBAPP_HOST}:{WEBAPP_PORT}")
     except Exception as e:
         logger.warning(f"Failed to start health server: {e}")
+    await start_background_jobs()
+
+async def on_shutdown_polling(dp: Dispatcher):
+    await stop_background_jobs()
+    shutdown_db()
 
 if __name__ == '__main__':
     print("🚀 Запуск бота ELF OTC...")
@@ -2199,4 +4296,4 @@ if __name__ == '__main__':
     else:
         # Поллинг-режим (дефолтно для локальной разработки)
         print("🟢 Polling mode (set WEBHOOK_URL to enable webhook)")
-        executor.start_polling(dp, skip_updates=True, on_startup=on_startup_polling)
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup_polling, on_shutdown=on_shutdown_polling)
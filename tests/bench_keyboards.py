@@ -0,0 +1,44 @@
+"""Бенчмарк клавиатур: мкс на вызов до/после кэша cached_keyboard.
+
+Запуск: python tests/bench_keyboards.py. «До» — прежний путь: проверка прав,
+язык пользователя, сборка InlineKeyboardMarkup и сериализация на каждый вызов;
+«после» — main_menu_keyboard с прогретым кэшем языка.
+"""
+import os
+import sys
+import tempfile
+import time
+
+CALLS = 20000
+USER_ID = 900001
+
+
+def bench(func, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        func(USER_ID)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp(prefix='elf_bench_'))
+    os.environ['DB_PATH'] = os.path.abspath('keyboards.db')
+    import ELF
+
+    with ELF.db.write() as conn:
+        conn.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (USER_ID, 'bench'))
+    ELF.get_user_language(USER_ID)
+    builder = ELF.KEYBOARD_BUILDERS['main_menu'][0]
+
+    def old_keyboard(user_id):
+        privileged = user_id in ELF.ADMIN_IDS or ELF.is_special_user(user_id)
+        return builder(ELF.get_user_language(user_id), privileged).as_json()
+
+    print(f'main_menu  before {bench(old_keyboard, CALLS):7.2f} us/call   '
+          f'after {bench(ELF.main_menu_keyboard, CALLS):7.2f} us/call')
+    ELF.shutdown_db()
+
+
+if __name__ == '__main__':
+    main()
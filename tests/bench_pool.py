@@ -0,0 +1,68 @@
+"""Бенчмарк пула соединений: ops/s чтения и записи до/после ConnectionPool.
+
+Запуск: python tests/bench_pool.py. «До» — прежний способ хелперов: новое
+соединение sqlite3 на каждый вызов и журнал по умолчанию (DELETE); «после» —
+долгоживущие соединения пула в WAL.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+USERS = 2000
+READS = 5000
+WRITES = 1000
+
+
+def bench(func, n):
+    started = time.perf_counter()
+    for i in range(n):
+        func(i % USERS + 1)
+    return n / (time.perf_counter() - started)
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(tempfile.mkdtemp(prefix='elf_bench_'))
+    os.environ['DB_PATH'] = os.path.abspath('pool_pooled.db')
+    import ELF
+
+    with ELF.db.write() as conn:
+        conn.executemany('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)',
+                         [(i, f'user{i}') for i in range(1, USERS + 1)])
+    ELF.db.close()
+    # Копия базы в журнале по умолчанию — как работали хелперы до пула
+    legacy = os.path.abspath('pool_legacy.db')
+    src, dst = sqlite3.connect(ELF.DB_PATH), sqlite3.connect(legacy)
+    src.backup(dst)
+    dst.execute('PRAGMA journal_mode = DELETE')
+    src.close()
+    dst.close()
+
+    def old_read(user_id):
+        conn = sqlite3.connect(legacy)
+        try:
+            return conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        finally:
+            conn.close()
+
+    def old_write(user_id):
+        conn = sqlite3.connect(legacy)
+        try:
+            conn.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def new_write(user_id):
+        with ELF.db.write() as conn:
+            conn.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
+
+    print(f'read   before {bench(old_read, READS):8.0f} ops/s   after {bench(ELF.get_user, READS):8.0f} ops/s')
+    print(f'write  before {bench(old_write, WRITES):8.0f} ops/s   after {bench(new_write, WRITES):8.0f} ops/s')
+    ELF.shutdown_db()
+
+
+if __name__ == '__main__':
+    main()
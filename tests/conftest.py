@@ -0,0 +1,23 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def elf(tmp_path_factory):
+    # DB_PATH читается при импорте, а импорт сразу применяет миграции и
+    # создает special_admins.json в текущем каталоге — уводим все во временный
+    workdir = tmp_path_factory.mktemp('db')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ['DB_PATH'] = str(workdir / 'elf_otc.db')
+    try:
+        module = importlib.import_module('ELF')
+        module.init_db()
+        yield module
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+
+SELLER_ID = 700001
+BUYER_IDS = range(700100, 700110)
+UPDATES = 300
+
+
+class FakeMessage:
+    message_id = 1
+
+
+async def fake_api_call(*args, **kwargs):
+    return FakeMessage()
+
+
+def start_update(update_id, user_id, text):
+    return types.Update(**{
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Buyer', 'username': f'buyer{user_id}'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/start')}],
+        },
+    })
+
+
+@pytest.fixture
+def current_bot(elf):
+    """Bot/Dispatcher.set_current на время теста; после — прежние значения контекста."""
+    # set_current не возвращает токен, поэтому ставим значения в ContextVar напрямую
+    tokens = [(var, var.set(value)) for var, value in (
+        (Bot._ContextInstanceMixin__context_instance, elf.bot),
+        (Dispatcher._ContextInstanceMixin__context_instance, elf.dp),
+    )]
+    yield
+    for var, token in reversed(tokens):
+        var.reset(token)
+
+
+def test_pay_link_updates_do_not_reread_the_deal(elf, monkeypatch, current_bot):
+    """Нагрузочный прогон ссылок pay_<memo>: сделка и карточка продавца берутся из кэша, а не из SELECT на каждый апдейт."""
+    statements = []
+
+    class TracedPool(elf.ConnectionPool):
+        def _connect(self, readonly=False):
+            conn = super()._connect(readonly)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+    pool = TracedPool(elf.DB_PATH, elf.DB_READERS)
+    monkeypatch.setattr(elf, 'db', pool)
+    for name in ('send_message', 'send_photo', 'delete_message', 'edit_message_text'):
+        monkeypatch.setattr(elf.bot, name, fake_api_call)
+
+    memo = 'a1b2c3d4'
+    elf.touch_user(SELLER_ID, 'seller', 'Seller', '', SELLER_ID, 'private', '')
+    elf.create_deal('00000000-0000-0000-0000-000000700001', memo, SELLER_ID, 'stars', 10, 'Stars', 'gift')
+
+    async def run():
+        for i in range(UPDATES):
+            buyer = BUYER_IDS[i % len(BUYER_IDS)]
+            await elf.dp.process_update(start_update(i + 1, buyer, f'/start pay_{memo}'))
+
+    statements.clear()
+    try:
+        asyncio.run(run())
+    finally:
+        pool.close()
+
+    selects = [' '.join(q.split()) for q in statements if q.lstrip().upper().startswith('SELECT')]
+    deal_selects = [q for q in selects if 'FROM deals' in q]
+    card_selects = [q for q in selects if q.startswith('SELECT username, successful_deals FROM users')]
+    ratio = f'{len(selects) / UPDATES:.2f} SELECT per update'
+    assert deal_selects == [], ratio
+    # Карточку продавца читаем один раз, дальше — из creator_cache
+    assert len(card_selects) <= 1, ratio
@@ -0,0 +1,12 @@
+def test_rename_is_not_reported_as_drift(elf):
+    user_id = 810001
+    elf.touch_user(user_id, 'before', 'Top', '', user_id, 'private', '')
+    with elf.db.write() as conn:
+        elf._bump_successful_deals(conn, user_id, 10_000)
+    elf.reconcile_leaderboard()
+    drift_fixes = elf.leaderboard_stats['drift_fixes']
+
+    elf.touch_user(user_id, 'after', 'Top', '', user_id, 'private', '')
+    assert (user_id, 'after', 10_000) in elf.get_top_successful_users(elf.LEADERBOARD_SIZE)
+    assert elf.reconcile_leaderboard() is False
+    assert elf.leaderboard_stats['drift_fixes'] == drift_fixes
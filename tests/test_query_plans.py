@@ -0,0 +1,15 @@
+def test_hot_queries_use_indexes(elf):
+    elf.check_query_plans()
+
+
+def test_hot_queries_use_indexes_after_analyze(elf):
+    # С собранной статистикой планировщик выбирает планы иначе, чем на пустой базе
+    with elf.db.write() as conn:
+        conn.executemany('INSERT OR IGNORE INTO users (user_id, username, successful_deals, registered_at) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(i, f'user{i}', i % 50, f'2025-01-{i % 28 + 1:02d} 00:00:00') for i in range(1, 5001)])
+        conn.executemany('INSERT OR IGNORE INTO deals (deal_id, memo_code, creator_id, buyer_id, status) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(f'deal{i}', f'memo{i}', i, i + 1, 'completed' if i % 3 else 'active') for i in range(1, 2001)])
+        conn.execute('ANALYZE')
+    elf.check_query_plans()
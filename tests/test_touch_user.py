@@ -0,0 +1,42 @@
+import sqlite3
+
+
+def test_first_start_sets_last_active_on_legacy_schema(elf, monkeypatch, tmp_path):
+    # База до появления banned/last_active: миграция v1 добавляет last_active без DEFAULT
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            language TEXT DEFAULT 'ru',
+            ton_wallet TEXT,
+            card_details TEXT,
+            referral_count INTEGER DEFAULT 0,
+            earned_from_referrals REAL DEFAULT 0.0,
+            successful_deals INTEGER DEFAULT 0,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'old')")
+    conn.commit()
+    conn.close()
+
+    pool = elf.ConnectionPool(path, 1)
+    monkeypatch.setattr(elf, 'db', pool)
+    try:
+        elf.init_db()
+        with pool.read() as conn:
+            default = [row[4] for row in conn.execute('PRAGMA table_info(users)') if row[1] == 'last_active'][0]
+        assert default is None
+
+        elf.touch_user(800001, 'newbie', 'New', '', 800001, 'private', '')
+        with pool.read() as conn:
+            last_active = conn.execute('SELECT last_active FROM users WHERE user_id = 800001').fetchone()[0]
+            activity = conn.execute('SELECT COUNT(*) FROM user_activity_daily WHERE user_id = 800001').fetchone()[0]
+    finally:
+        pool.close()
+    assert last_active is not None
+    assert activity == 1